@@ -1,6 +1,6 @@
 
 ## use the Label Studio API to make predictions on a set of images
-## process the predictions using detect.py and send them to the API
+## the model is loaded once and the predictions are sent to the API
 
 import os
 import sys
@@ -10,6 +10,21 @@ from PIL import Image
 from io import BytesIO
 import time
 import shutil
+import random
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+
+from models.experimental import attempt_load
+from utils.datasets import LoadImages, img_formats
+from utils.general import check_img_size, non_max_suppression, scale_coords, xyxy2xywh
+from utils.label_studio import api_session, import_tasks, project_images
+from utils.plots import plot_one_box
+from utils.torch_utils import select_device
 
 # set up the command line arguments
 parser = argparse.ArgumentParser(description='Make predictions on a set of images using the Label Studio API')
@@ -20,6 +35,8 @@ parser.add_argument('--url_image_dir', type=str, default='./../Data/images', hel
 parser.add_argument('--output_dir', type=str, default='./..', help='directory to save the predictions')
 parser.add_argument('--database_predicted_dir', type=str, default='./../Data/Database_Predicted', help='directory to save the predictions')
 parser.add_argument('--weights', type=str, default='./../weights/best.pt', help='path to the model weights')
+parser.add_argument('--img_size', type=int, default=640, help='inference size (pixels)')
+parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
 parser.add_argument('--conf_thres', type=float, default=0.25, help='object confidence threshold')
 parser.add_argument('--iou_thres', type=float, default=0.45, help='IOU threshold for NMS')
 parser.add_argument('--augment', action='store_true', help='augment images for increased accuracy')
@@ -33,6 +50,11 @@ parser.add_argument('--project_name', type=str, default='Predictions', help='nam
 parser.add_argument('--label_config', type=str, default='./label_config.xml', help='path to the label config file')
 parser.add_argument('--label_config_url', type=str, default=None, help='URL of the label config file')
 parser.add_argument('--label_config_json', type=str, default=None, help='path to the label config JSON file')
+parser.add_argument('--workers', type=int, default=8, help='number of concurrent url downloads and import requests')
+parser.add_argument('--retries', type=int, default=3, help='number of retries with exponential backoff for failed http requests')
+parser.add_argument('--import_batch', type=int, default=50, help='number of tasks sent per Label Studio import request')
+parser.add_argument('--manifest', type=str, default=None, help='manifest of predicted and uploaded images, default is database_predicted_dir/manifest.jsonl')
+parser.add_argument('--non_interactive', action='store_true', help='do not ask for confirmation and upload the predictions as they complete')
 # API Token
 parser.add_argument('--api_token', type=str, default='dd3f146381240448ef590c41563d274931ab6c84', help='API Token')
 
@@ -41,8 +63,12 @@ args = parser.parse_args()
 # provide API authentication credentials
 TOKEN = args.api_token
 
+# keep-alive session shared by all api calls and url downloads, GET and PUT requests are retried with exponential
+# backoff (0.5s, 1s, 2s, ...), imports are resubmitted by import_tasks() only for the tasks the project does not have
+session = api_session(TOKEN, retries=args.retries, workers=args.workers)
+
 # authenticate with the API
-response = requests.get(args.api_url + '/projects', headers={'Authorization': 'Token ' + TOKEN})
+response = session.get(args.api_url + '/projects')
 # check that the authentication was successful
 if response.status_code != 200:
     print('ERROR: authentication with API failed')
@@ -77,7 +103,11 @@ print('found', len(image_files), 'images to be predicted in file:', args.input_d
 # convert an image url to a saved image in image_path
 def url_to_image(url):
     # download the image, 
-    response = requests.get(url)
+    try:
+        response = session.get(url, headers={'Authorization': None}, timeout=30)  # do not leak the api token to other hosts
+    except requests.exceptions.RequestException as e:
+        print('not possible to download image from url:', url, e)
+        return None
     # if response is 200 (OK), then convert the image to a numpy array
     if response.status_code == 200:
         image = Image.open(BytesIO(response.content))
@@ -107,12 +137,13 @@ if len(url_files) > 0:
     # remove '\n' from the end of each url
     url_list = [url.rstrip('\n') for url in url_list]
 
-    # create a list of images
+    # download the images in parallel, keeping the order of the url files
     image_list = []
-    for url in url_list:
-        if url_to_image(url) is not None:
-            image_list.append(url_to_image(url))
-            print('downloaded and converted image', url)
+    with ThreadPoolExecutor(args.workers) as pool:
+        for url, image in zip(url_list, pool.map(url_to_image, url_list)):
+            if image is not None:
+                image_list.append(image)
+                print('downloaded and converted image', url)
 
     # save the list of images inside url_image_dir
     for i in range(len(image_list)):
@@ -133,7 +164,7 @@ if len(url_files) > 0:
 
 
 # get the project id from the project name
-response = requests.get(args.api_url + '/projects', headers={'Authorization': 'Token ' + TOKEN})
+response = session.get(args.api_url + '/projects')
 if response.status_code != 200:
     print('ERROR: could not get the list of projects')
     sys.exit()
@@ -150,7 +181,7 @@ else:
 
 
 # get the list of tasks
-response = requests.get(args.api_url + '/projects/' + project_id + '/tasks/', headers={'Authorization': 'Token ' + TOKEN})
+response = session.get(args.api_url + '/projects/' + project_id + '/tasks/')
 # print the number of tasks returned by the API
 if response.status_code != 200:
     tasks = response.json()
@@ -170,64 +201,212 @@ else: # code 200
 
 
 # get the total annotations of the project : project["total_annotations_number"] by using GET /api/projects/{project_id}
-project = requests.get(args.api_url + '/projects/' + project_id, headers={'Authorization': 'Token ' + TOKEN}).json()
+project = session.get(args.api_url + '/projects/' + project_id).json()
 # print the number of annotations in the project
 print('found', project['total_annotations_number'], 'annotations and', project['total_predictions_number'], 'predictions in project:',  args.project_name)
 
 ###############################################################################################################################################3
 # The images are locally processed and predicted then imported to the project
 
-# predict the image using the YOLO detect.py script
-# python detect.py --weights args.weights --img 640 --conf 0.25 --source args.input_dir --save-txt --project args.output_dir
-# call the detect.py script with its flags
-old_labels_dir = args.output_dir + '/Data/labels'
+# load the YOLO model once and predict the images in-process instead of shelling out to detect.py,
+# the Label Studio payloads are built straight from the detection tensors
 old_images_dir = args.input_dir
 
 # create a new folder in the database with the time string
 Data_folder = args.database_predicted_dir + '/' + time_string
 os.mkdir(Data_folder)
 
-# if the labels directory is empty, try the os command
-if not os.listdir(old_labels_dir):
-    try:
-        os.system('python detect.py --weights ' + args.weights + ' --img 640 --conf 0.25 --source ' 
-        + args.input_dir + ' --save-txt --project ' + args.output_dir + ' --name Data' + ' --exist-ok')
-        print('Predictions saved in', args.output_dir)
-        # create a predictions directory
-        predictions_dir = args.output_dir + '/Data/predictions'
-        os.mkdir(predictions_dir)
-        # put all the images.jpg deom /Data to /Data/predictions
-        for image in os.listdir(args.output_dir + '/Data'):
-            if image.endswith('.jpg') or image.endswith('.png'):
-                shutil.move(args.output_dir + '/Data/' + image, predictions_dir)
-        new_predictions_dir = Data_folder + '/predictions'
-        print('moving', len(os.listdir(predictions_dir)), 'predictions to the database')
-        shutil.move(predictions_dir, new_predictions_dir)
-        time.sleep(0.2)
+# create images, labels and predictions inside
+images_dir = Data_folder + '/images'
+labels_dir = Data_folder + '/labels'
+predictions_dir = Data_folder + '/predictions'
+os.mkdir(images_dir)
+os.mkdir(labels_dir)
+os.mkdir(predictions_dir)
+
+Classes = {1: 'Special Forces', 2: 'Terrorist', 0: 'Civilian', 3: 'Weapon'}
 
+# convert the detections of one image (xyxy, conf, cls in original pixels) to the label studio format
+def detections_to_labels(image_id, det, image_width, image_height):
+    labels = []
+    for num, (x1, y1, x2, y2, conf, cls) in enumerate(det.tolist()):
+        labels.append({
+            "id": image_id + '_' + str(num),
+            "from_name": "label",
+            "to_name": "image",
+            "type": "rectanglelabels",
+            "value": {
+                        "x": x1 / image_width * 100,
+                        "y": y1 / image_height * 100,
+                        "width": (x2 - x1) / image_width * 100,
+                        "height": (y2 - y1) / image_height * 100,
+                        "rotation": 0.0,
+                        "rectanglelabels": [
+                                            Classes[int(cls)]
+                                            ]
+                    }
+                 })
+    return labels
+
+device = select_device(args.device)
+half = device.type != 'cpu'  # half precision only supported on CUDA
+model = attempt_load(args.weights, map_location=device)  # load FP32 model
+stride = int(model.stride.max())  # model stride
+imgsz = check_img_size(args.img_size, s=stride)  # check img_size
+if half:
+    model.half()  # to FP16
+names = model.module.names if hasattr(model, 'module') else model.names
+colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
+if device.type != 'cpu':
+    model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
+
+# manifest of every image ever seen, keyed by the image content hash. It is an append-only jsonl file of state
+# changes (predicted -> uploaded) so reruns skip finished work and a crashed run resumes where it stopped
+manifest_path = args.manifest or args.database_predicted_dir + '/manifest.jsonl'
+manifest = {}  # hash: latest record
+if os.path.isfile(manifest_path):
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # line cut by a crash
+                continue
+            manifest.setdefault(entry['hash'], {}).update(entry)
+manifest_file = open(manifest_path, 'a+')
+if manifest_file.tell():
+    manifest_file.seek(manifest_file.tell() - 1)
+    if manifest_file.read(1) != '\n':
+        manifest_file.write('\n')  # terminate a partially written line
+manifest_lock = threading.Lock()
+print('found', len(manifest), 'images in manifest:', manifest_path)
+
+def record(entry):
+    # append a state change to the manifest, flushed so a crash loses at most the line being written
+    with manifest_lock:
+        manifest.setdefault(entry['hash'], {}).update(entry)
+        manifest_file.write(json.dumps(entry) + '\n')
+        manifest_file.flush()
+
+def file_hash(path):
+    # md5 of the file content
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# images that are already in the manifest are not predicted again. If the crash happened between recording
+# the prediction and moving the image it is moved to its database folder now, otherwise it is a duplicate
+duplicates_dir = Data_folder + '/duplicates'
+hashes = {}  # image_file: hash of the images to be predicted
+for image_file in sorted(os.listdir(old_images_dir)):
+    path = old_images_dir + '/' + image_file
+    if not (os.path.isfile(path) and image_file.split('.')[-1].lower() in img_formats):
+        continue
+    h = file_hash(path)
+    if h in manifest:
+        entry = manifest[h]
+        target = args.database_predicted_dir + '/' + entry['folder'] + '/images/' + entry['image']
+        if not os.path.exists(target):
+            shutil.move(path, target)
+        else:
+            os.makedirs(duplicates_dir, exist_ok=True)
+            shutil.move(path, duplicates_dir + '/' + image_file)
+            print('skipping', image_file, 'already', entry['state'], 'as', entry['folder'] + '/' + entry['image'])
+    else:
+        hashes[image_file] = h
+pending = [h for h, entry in manifest.items() if entry['state'] == 'predicted']
+if pending:  # a previous run may have crashed after the import was accepted but before it was recorded
+    present = project_images(session, args.api_url, project_id)
+    for h in pending:
+        if manifest[h]['payload']['data']['image'] in present:
+            record({'hash': h, 'state': 'uploaded'})
+    pending = [h for h in pending if manifest[h]['state'] == 'predicted']
+print('found', len(hashes), 'new images to be predicted and', len(pending), 'predicted images still to be uploaded')
+
+def import_batch(batch):
+    # import a list of tasks and mark the ones now in the project uploaded, returns None on success or the error message
+    done, error = import_tasks(session, args.api_url, project_id, [manifest[h]['payload'] for h in batch], retries=args.retries)
+    for i in done:
+        record({'hash': batch[i], 'state': 'uploaded'})
+    return error
+
+# in --non_interactive mode the uploads are streamed, a batch is submitted as soon as it is full
+pool = ThreadPoolExecutor(args.workers)
+futures = []  # (batch, future)
+
+def submit(batch):
+    if batch:
+        futures.append((batch, pool.submit(import_batch, batch)))
+
+if args.non_interactive:
+    for i in range(0, len(pending), args.import_batch):
+        submit(pending[i:i + args.import_batch])
+    pending = []
+
+t0 = time.time()
+n = 0
+if hashes:
+    try:
+        for path, img, im0, _ in LoadImages(args.input_dir, img_size=imgsz, stride=stride):
+            image_file = os.path.basename(path)
+            if image_file not in hashes:  # not an image
+                continue
+            image_id = image_file.split('.')[0]
+            # the pixel size is taken from the decoded image, no need to re-open it
+            image_height, image_width = im0.shape[:2]
+
+            img = torch.from_numpy(img).to(device)
+            img = img.half() if half else img.float()  # uint8 to fp16/32
+            img /= 255.0  # 0 - 255 to 0.0 - 1.0
+            with torch.no_grad():
+                pred = model(img.unsqueeze(0), augment=args.augment)[0]
+            det = non_max_suppression(pred, args.conf_thres, args.iou_thres, classes=args.classes, agnostic=args.agnostic_nms)[0]
+            det[:, :4] = scale_coords(img.shape[1:], det[:, :4], im0.shape).round()
+
+            # keep a yolo label file in the database as a record of the prediction
+            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            with open(labels_dir + '/' + image_id + '.txt', 'w') as f:
+                for *xyxy, conf, cls in det.tolist():
+                    xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                    line = (cls, *xywh, conf) if args.save_conf else (cls, *xywh)  # label format
+                    f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+            if not args.nosave:
+                for *xyxy, conf, cls in det.tolist():
+                    plot_one_box(xyxy, im0, label=f'{names[int(cls)]} {conf:.2f}', color=colors[int(cls)], line_thickness=1)
+                cv2.imwrite(predictions_dir + '/' + image_file, im0)
+
+            image_url = 'http://0.0.0.0:1212/' + time_string + '/images/' + image_file
+            payload = {
+                "data": {
+                    "image": image_url
+                },
+                "predictions": [
+                    {
+                        "model_version": "one", ## TRAINED MODEL Reference ID
+                        "score": 0.5,
+                        "result": detections_to_labels(image_id, det, image_width, image_height)
+                    }
+                ]
+            }
+            # record the prediction first, then move the image to the database
+            h = hashes[image_file]
+            record({'hash': h, 'image': image_file, 'folder': time_string, 'state': 'predicted', 'payload': payload})
+            shutil.move(path, images_dir + '/' + image_file)
+            print('predicted', image_file, 'with', len(det), 'detections')
+            n += 1
+
+            pending.append(h)
+            if args.non_interactive and len(pending) >= args.import_batch:
+                submit(pending)
+                pending = []
     except Exception as e:
         print('ERROR: could not predict the images')
         print(e)
         sys.exit()
-else: print('As the label directory is not empty, the images were not predicted')
-
-# print('local_dir', local_dir)
-# response = requests.post(args.api_url + '/storages/localfiles', 
-# headers={'Authorization': 'Token ' + TOKEN},
-# json={
-#     "path": local_dir + '/' + args.input_dir,
-#     "regex_filter": None,
-#     "use_blob_urls": False,
-#     "title": "YOLOv7 predictions",
-#     "description": "YOLOv7 predictions",
-#     "last_sync": None,
-#     "last_sync_count": None,
-#     "project": project_id
-# })
-# print(response.status_code)
-# print(response.json())
-
-# sys.exit()
+print('predicted', n, 'images in', f'{time.time() - t0:.3f}s')
+
 #--------------------------------------------------------------------------------------------------------------
 '''
 Note, but didn^t work
@@ -243,29 +422,6 @@ python3 -m http.server 1212
 Just make sure it is still active when you export the images
 '''
 print('-----------------------------------------------------------------------------------------------------------------')
-print('Will now move DATA to Database and free folders')
-
-# cut url folder content and paste in Database_Predicted/url
-# move the images and labels to the database
-
-
-# create images and labels inside
-images_dir = Data_folder + '/images'
-labels_dir = Data_folder + '/labels'
-os.mkdir(images_dir)
-os.mkdir(labels_dir)
-
-print('moving', len(os.listdir(old_labels_dir)), 'labels to the database')
-for file in os.listdir(old_labels_dir):
-    shutil.move(old_labels_dir + '/' + file, labels_dir + '/' + file)
-
-print('moving', len(os.listdir(old_images_dir)), 'images to the database')
-for file in os.listdir(old_images_dir):
-    shutil.move( old_images_dir + '/' + file, images_dir + '/' + file)
-
-time.sleep(0.2)
-
-
 print('making a record of processed url files')
 url_files = [f for f in os.listdir(args.url_dir) if os.path.isfile(os.path.join(args.url_dir, f)) and f.lower().endswith(('.txt')) and not f.startswith('Processed')]
 for file in url_files:
@@ -273,134 +429,45 @@ for file in url_files:
     shutil.copy(args.url_dir + '/' + file, args.url_dir + '/' + 'Processed.' + file.split('.')[0] + '_' + time_string + '.txt')
 print('-----------------------------------------------------------------------------------------------------------------')
 
-# The labels and images are imported to the project
-# get the list of labels to be imported
-print('labels dir is: ', labels_dir)
-label_files = [f for f in os.listdir(labels_dir) if os.path.isfile(os.path.join(labels_dir, f)) and f.lower().endswith(('.txt'))]
-label_files.sort()
-
-print('images dir is: ', images_dir)
-# get the list of images to be imported
-image_files = [f for f in os.listdir(images_dir) if os.path.isfile(os.path.join(images_dir, f)) and f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-image_files.sort()
-
-print('found', len(label_files), 'labels and', len(image_files), 'images to be imported')
-
-## wait until enter is pressed to confitm the upload to the server
-print('-----------------------------------------------------------------------------------------------------------------')
-print('type c to confirm the upload to the server')
-print('-----------------------------------------------------------------------------------------------------------------')
-print('type t to terminate the script')
-print('-----------------------------------------------------------------------------------------------------------------')
-while True:
-    # ask the user to type c to continue
-    i = input()
-    if i == 'c':
-        print('Starting the upload to the server')
-        break
-    elif i == 't':
-        print('Terminating the script')
-        sys.exit()
-    else:
-        print('waiting for operator to type c')
-    
-
-# create the import storage
-local_dir = os.path.dirname(os.path.realpath(__file__))
-
-Classes = {'1': 'Special Forces', '2': 'Terrorist', '0': 'Civilian', '3': 'Weapon'} 
-for image_file in image_files:
-    # get the image id from the image file name
-    image_id = image_file.split('.')[0]
-    # get the label file name from the image file name
-    label_file = image_id + '.txt'
-    # get the image url
-    #image_url = 'file://' + local_dir + '/' + images_dir + '/' + image_file
-    image_url = 'http://0.0.0.0:1212/' + time_string + '/images/' + image_file
-    # get the label file path
-    label_file_path = labels_dir + '/' + label_file
-    # get the pixel width
-    image_width = Image.open(images_dir + '/' + image_file).size[0]
-    # get the pixel height
-    image_height = Image.open(images_dir + '/' + image_file).size[1]
-    # get the labels
-    labels = []
-    num = 0
-    with open(label_file_path) as f:
-        for line in f:
-            
-            # get the label
-            label = line.split()
-            # get the label name
-            label_name = label[0]
-            # get the label coordinates
-            x = float(label[1]) * 100
-            y = float(label[2]) * 100
-            width = float(label[3]) * 100
-            height = float(label[4]) * 100
-            rotation = 0.0
-            # convert the label to the label studio format
-            x = x - width / 2
-            y = y - height / 2
-
-            # create the label
-            label =  {
-                "id": image_id + '_' + str(num),
-                "from_name": "label", 
-                "to_name": "image",
-                "type": "rectanglelabels",
-                # "original_width": image_width,
-                # "original_height": image_height,
-                # "image_rotation": 0,
-                "value": {
-                            "x": x,
-                            "y": y,
-                            "width": width,
-                            "height": height,
-                            "rotation": rotation,
-                            "rectanglelabels": [
-                                                Classes[label_name]
-                                                ]
-                        }
-                     }
-            
-            # add the label to the list of labels
-            labels.append(label)
-            num = num+1
-
-    # create the payload
-    payload = {
-        "data": {
-            "image": image_url
-        },
-        "predictions": [
-            {   
-                "model_version": "one", ## TRAINED MODEL Reference ID
-                "score": 0.5,
-                "result": labels
-                                
-            }
-        ]
-    }
-
-    try:
-        response = requests.post(args.api_url + '/projects/' + project_id + '/import', headers={'Authorization': 'Token ' + TOKEN} , json=payload)
-        #print(response.status_code)
-        #print(response.text)
-        # check if the response status_code is 201 for success
-        if response.status_code == 201:
-            pass
-        else:
-            print('ERROR: could not import image: ', image_file)
-            print('details:' ,response['detail'])
-            print(response['validation_errors']['non_field_errors'])
-            if not response['exc_info'] == None:
-                print('exc_info : \n',response['exc_info'])
+if not args.non_interactive:
+    print('found', len(pending), 'predictions to be imported')
+
+    ## wait until enter is pressed to confitm the upload to the server
+    print('-----------------------------------------------------------------------------------------------------------------')
+    print('type c to confirm the upload to the server')
+    print('-----------------------------------------------------------------------------------------------------------------')
+    print('type t to terminate the script')
+    print('-----------------------------------------------------------------------------------------------------------------')
+    while True:
+        # ask the user to type c to continue
+        i = input()
+        if i == 'c':
+            print('Starting the upload to the server')
+            break
+        elif i == 't':
+            print('Terminating the script, the predictions are kept in the manifest for the next run')
             sys.exit()
-        response = response.json()
-        print('imported', image_id, 'to the project')
-        # print(response)
-    except:
-        print('ERROR: could not import image', image_id, 'to project', args.project_name)
-        print(response.json())
-        sys.exit()
+        else:
+            print('waiting for operator to type c')
+
+# The predictions are imported to the project, several tasks per import request and several requests in flight
+t0 = time.time()
+for i in range(0, len(pending), args.import_batch):
+    submit(pending[i:i + args.import_batch])
+failed = []
+for batch, future in futures:
+    error = future.result()
+    if error is None:
+        print('imported', len(batch), 'images to the project:', ', '.join(manifest[h]['image'].split('.')[0] for h in batch))
+    else:
+        batch = [h for h in batch if manifest[h]['state'] == 'predicted']  # not imported
+        print('ERROR: could not import images', [manifest[h]['image'] for h in batch], 'to project', args.project_name)
+        print('details:', error)
+        failed += batch
+pool.shutdown()
+manifest_file.close()
+n = sum(len(batch) for batch, _ in futures)
+print('imported', n - len(failed), 'of', n, 'images in', f'{time.time() - t0:.3f}s')
+if failed:
+    print(len(failed), 'images stay predicted in the manifest and will be uploaded on the next run')
+    sys.exit(1)
@@ -1,3 +1,10 @@
+import sys
+
+from utils.startup import profiler
+
+if '--profile-startup' in sys.argv:
+    profiler.start()
+
 import argparse
 import time
 from pathlib import Path
@@ -7,15 +14,17 @@ import torch
 import torch.backends.cudnn as cudnn
 from numpy import random
 
-from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from models.experimental import attempt_load_deploy
+from models.yolo import set_tta
+from utils.datasets import LoadStreams, LoadImages, LoadImagesPrefetch
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
-    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
+    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path, ResultWriter
 from utils.plots import plot_one_box
-from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
+from utils.torch_utils import select_device, load_classifier, time_synchronized
 
 
 def detect(save_img=False):
+    profiler.stop_imports()
     source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
     save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
@@ -31,15 +40,14 @@ def detect(save_img=False):
     half = device.type != 'cpu'  # half precision only supported on CUDA
 
     # Load model
-    model = attempt_load(weights, map_location=device)  # load FP32 model
+    model = attempt_load_deploy(weights, device, opt.img_size, trace)  # load fused (and traced) FP32 model, cached
     stride = int(model.stride.max())  # model stride
     imgsz = check_img_size(imgsz, s=stride)  # check img_size
 
-    if trace:
-        model = TracedModel(model, device, opt.img_size)
-
     if half:
         model.half()  # to FP16
+    if opt.augment:
+        set_tta(model, opt.tta_scales, opt.tta_flips, opt.tta_fill)  # --augment views
 
     # Second-stage classifier
     classify = False
@@ -48,11 +56,14 @@ def detect(save_img=False):
         modelc.load_state_dict(torch.load('weights/resnet101.pt', map_location=device)['model']).to(device).eval()
 
     # Set Dataloader
-    vid_path, vid_writer = None, None
+    vid_path, vid_file = None, None
+    writer = ResultWriter()  # background label/image/video writer
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
         dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+    elif opt.batch_size > 1:  # batched inference on rectangular batches of similarly shaped images
+        dataset = LoadImagesPrefetch(source, img_size=imgsz, stride=stride, batch_size=opt.batch_size, rect=True)
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride)
 
@@ -62,9 +73,9 @@ def detect(save_img=False):
 
     # Run inference
     if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
-    old_img_w = old_img_h = imgsz
-    old_img_b = 1
+        with profiler.phase('warmup'):
+            model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
+    warmed = set()  # input shapes already warmed up
 
     t0 = time.time()
     for path, img, im0s, vid_cap in dataset:
@@ -74,11 +85,9 @@ def detect(save_img=False):
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
 
-        # Warmup
-        if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
-            old_img_b = img.shape[0]
-            old_img_h = img.shape[2]
-            old_img_w = img.shape[3]
+        # Warmup (once per input shape)
+        if device.type != 'cpu' and tuple(img.shape) not in warmed:
+            warmed.add(tuple(img.shape))
             for i in range(3):
                 model(img, augment=opt.augment)[0]
 
@@ -86,9 +95,13 @@ def detect(save_img=False):
         t1 = time_synchronized()
         pred = model(img, augment=opt.augment)[0]
         t2 = time_synchronized()
+        if profiler.enabled:  # --profile-startup, report once after the first inference
+            profiler.add('inference', t2 - t1)
+            profiler.report()
 
         # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                                   backend=opt.nms_backend, soft=opt.soft_nms, merge=opt.merge_nms)
         t3 = time_synchronized()
 
         # Apply Classifier
@@ -99,6 +112,8 @@ def detect(save_img=False):
         for i, det in enumerate(pred):  # detections per image
             if webcam:  # batch_size >= 1
                 p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
+            elif isinstance(path, list):  # batched images
+                p, s, im0, frame = path[i], '', im0s[i], 0
             else:
                 p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
 
@@ -106,6 +121,7 @@ def detect(save_img=False):
             save_path = str(save_dir / p.name)  # img.jpg
             txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            lines = []  # label file lines
             if len(det):
                 # Rescale boxes from img_size to im0 size
                 det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
@@ -120,13 +136,15 @@ def detect(save_img=False):
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        lines.append(('%g ' * len(line)).rstrip() % line)
 
                     if save_img or view_img:  # Add bbox to image
                         label = f'{names[int(cls)]} {conf:.2f}'
                         plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
 
+                if lines:
+                    writer.labels(txt_path + '.txt', lines)  # one write per image
+
             # Print time (inference + NMS)
             print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
 
@@ -138,26 +156,24 @@ def detect(save_img=False):
             # Save results (image with detections)
             if save_img:
                 if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                    print(f" The image with the result is saved in: {save_path}")
+                    writer.image(save_path, im0)
+                    print(f" The image with the result is queued to be saved in: {save_path}")
                 else:  # 'video' or 'stream'
                     if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
+                        vid_path = vid_file = save_path
                         if vid_cap:  # video
                             fps = vid_cap.get(cv2.CAP_PROP_FPS)
                             w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
                             h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
                         else:  # stream
                             fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path += '.mp4'
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer.write(im0)
+                            vid_file += '.mp4'
+                    writer.frame(vid_file, im0, fps, w, h)
 
+    writer.close()  # flush queued results
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
-        #print(f"Results saved to {save_dir}{s}")
+        print(f"Results saved to {save_dir}{s}")  # after writer.close(), every queued file is on disk
 
     print(f'Done. ({time.time() - t0:.3f}s)')
 
@@ -167,6 +183,7 @@ if __name__ == '__main__':
     parser.add_argument('--weights', nargs='+', type=str, default='yolov7.pt', help='model.pt path(s)')
     parser.add_argument('--source', type=str, default='inference/images', help='source')  # file/folder, 0 for webcam
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=1, help='images per inference batch for file/folder sources')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
@@ -176,12 +193,19 @@ if __name__ == '__main__':
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --class 0, or --class 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--nms-backend', default='torchvision', choices=['torchvision', 'numpy'], help='NMS engine, numpy for CPU-only hosts')
+    parser.add_argument('--soft-nms', action='store_true', help='Gaussian Soft-NMS (numpy backend)')
+    parser.add_argument('--merge-nms', action='store_true', help='merge kept boxes with their overlaps (weighted mean)')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta-scales', nargs='+', type=float, help='--augment view scales, i.e. 1 0.83 0.67')
+    parser.add_argument('--tta-flips', nargs='+', type=int, help='--augment view flip per scale, 0 none 2 ud 3 lr, i.e. 0 3 0, none if only --tta-scales given')
+    parser.add_argument('--tta-fill', type=float, help='--augment pads views filling this fraction into one batch')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default='runs/detect', help='save results to project/name')
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--profile-startup', action='store_true', help='report import and startup phase times')
     opt = parser.parse_args()
     print(opt)
     #check_requirements(exclude=('pycocotools', 'thop'))
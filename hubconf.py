@@ -7,6 +7,8 @@ Usage:
 
 from pathlib import Path
 
+from utils.startup import profiler  # YOLOV7_PROFILE_STARTUP=1 to report import and load times
+
 import torch
 
 from models.yolo import Model
@@ -17,6 +19,7 @@ from utils.torch_utils import select_device
 dependencies = ['torch', 'yaml']
 check_requirements(Path(__file__).parent / 'requirements.txt', exclude=('pycocotools', 'thop'))
 set_logging()
+profiler.stop_imports()
 
 
 def create(name, pretrained, channels, classes, autoshape):
@@ -33,11 +36,13 @@ def create(name, pretrained, channels, classes, autoshape):
     """
     try:
         cfg = list((Path(__file__).parent / 'cfg').rglob(f'{name}.yaml'))[0]  # model.yaml path
-        model = Model(cfg, channels, classes)
+        with profiler.phase('build'):
+            model = Model(cfg, channels, classes)
         if pretrained:
             fname = f'{name}.pt'  # checkpoint filename
             attempt_download(fname)  # download if not found locally
-            ckpt = torch.load(fname, map_location=torch.device('cpu'))  # load
+            with profiler.phase('load'):
+                ckpt = torch.load(fname, map_location=torch.device('cpu'))  # load
             msd = model.state_dict()  # model state_dict
             csd = ckpt['model'].float().state_dict()  # checkpoint state_dict as FP32
             csd = {k: v for k, v in csd.items() if msd[k].shape == v.shape}  # filter
@@ -47,6 +52,7 @@ def create(name, pretrained, channels, classes, autoshape):
             if autoshape:
                 model = model.autoshape()  # for file/URI/PIL/cv2/np inputs and NMS
         device = select_device('0' if torch.cuda.is_available() else 'cpu')  # default to GPU if available
+        profiler.report()
         return model.to(device)
 
     except Exception as e:
@@ -65,16 +71,19 @@ def custom(path_or_model='path/to/model.pt', autoshape=True):
     Returns:
         pytorch model
     """
-    model = torch.load(path_or_model, map_location=torch.device('cpu')) if isinstance(path_or_model, str) else path_or_model  # load checkpoint
+    with profiler.phase('load'):
+        model = torch.load(path_or_model, map_location=torch.device('cpu')) if isinstance(path_or_model, str) else path_or_model  # load checkpoint
     if isinstance(model, dict):
         model = model['ema' if model.get('ema') else 'model']  # load model
 
-    hub_model = Model(model.yaml).to(next(model.parameters()).device)  # create
+    with profiler.phase('build'):
+        hub_model = Model(model.yaml).to(next(model.parameters()).device)  # create
     hub_model.load_state_dict(model.float().state_dict())  # load state_dict
     hub_model.names = model.names  # class names
     if autoshape:
         hub_model = hub_model.autoshape()  # for file/URI/PIL/cv2/np inputs and NMS
     device = select_device('0' if torch.cuda.is_available() else 'cpu')  # default to GPU if available
+    profiler.report()
     return hub_model.to(device)
 
 
@@ -1,3 +1,8 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
 import numpy as np
 import random
 import torch
@@ -5,6 +10,8 @@ import torch.nn as nn
 
 from models.common import Conv, DWConv
 from utils.google_utils import attempt_download
+from utils.startup import profiler
+from utils.torch_utils import TracedModel
 
 
 class CrossConv(nn.Module):
@@ -249,8 +256,10 @@ def attempt_load(weights, map_location=None):
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
         attempt_download(w)
-        ckpt = torch.load(w, map_location=map_location)  # load
-        model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
+        with profiler.phase('load'):
+            ckpt = torch.load(w, map_location=map_location)  # load
+        with profiler.phase('fuse'):
+            model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
     
     # Compatibility updates
     for m in model.modules():
@@ -270,3 +279,55 @@ def attempt_load(weights, map_location=None):
         return model  # return ensemble
 
 
+def attempt_load_deploy(weights, device, img_size=640, trace=True, cache_dir=None, keep=8):
+    # Loads weights fused (and traced if trace=True) for inference from a cache keyed by the weights content, image
+    # size, device type, torch version and the model code (a traced model freezes the forward of the code that traced
+    # it). On a miss the model is built with attempt_load() and written atomically. The cache directory, default
+    # ~/.cache/yolov7 or $YOLOV7_CACHE, keeps the keep most recently used models, older ones are deleted
+    files = weights if isinstance(weights, list) else [weights]
+    h = hashlib.sha256()
+    for w in files:
+        attempt_download(w)
+        with profiler.phase('hash'), open(w, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(f'{img_size} {device.type} {torch.__version__}'.encode())
+    root = Path(__file__).parent.parent
+    for code in ('models/yolo.py', 'models/common.py', 'models/experimental.py', 'utils/torch_utils.py'):
+        h.update((root / code).read_bytes())
+    cache_dir = Path(cache_dir or os.getenv('YOLOV7_CACHE', Path.home() / '.cache' / 'yolov7'))
+    f = cache_dir / f'{h.hexdigest()[:16]}.{"traced" if trace else "fused"}.pt'
+
+    if f.exists():
+        try:
+            with profiler.phase('cache'):
+                model = TracedModel(f, device) if trace else torch.load(f, map_location=device)
+            os.utime(f)  # most recently used
+            print(f'Deploy model loaded from {f}')
+            return model
+        except Exception as e:
+            print(f'WARNING: Deploy model cache {f} is unreadable ({e}), rebuilding')
+
+    model = attempt_load(weights, map_location=device)  # load FP32 model
+    if trace:
+        with profiler.phase('trace'):
+            model = TracedModel(model, device, img_size, save_path=None)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        if trace:
+            model.save(f)
+        else:
+            tmp = f'{f}.{os.getpid()}.tmp'
+            torch.save(model, tmp)
+            os.replace(tmp, f)
+        print(f'Deploy model cached to {f}')
+
+        # prune least recently used models and temporary files of crashed writers older than a day
+        old = sorted(list(cache_dir.glob('*.traced.pt')) + list(cache_dir.glob('*.fused.pt')),
+                     key=lambda x: x.stat().st_mtime, reverse=True)[keep:]
+        old += [x for x in cache_dir.glob('*.tmp') if time.time() - x.stat().st_mtime > 86400]
+        for x in old:
+            x.unlink(missing_ok=True)
+    except OSError as e:
+        print(f'WARNING: Deploy model cache directory {cache_dir} is not writeable ({e})')
+    return model
@@ -1,4 +1,5 @@
 import argparse
+import glob
 import logging
 import sys
 from copy import deepcopy
@@ -6,6 +7,8 @@ from copy import deepcopy
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
 logger = logging.getLogger(__name__)
 import torch
+import weakref
+
 from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
@@ -20,6 +23,28 @@ except ImportError:
     thop = None
 
 
+decode_cache = weakref.WeakKeyDictionary()  # detection head: {(layer, ny, nx, device, dtype, anchor version): terms}
+
+
+def decode_terms(m, i, nx, ny, device, dtype):
+    # Returns the grid of layer i of detection head m and the terms (q, g, b) of its fused box decode
+    # y[..., :4] = y * (y * q + g) + b, i.e. xy = (2y - 0.5 + grid) * stride and wh = (2y) ** 2 * anchor_grid.
+    # Cached per input shape, device and dtype so alternating input shapes do not rebuild them
+    cache = decode_cache.setdefault(m, {})
+    key = (i, ny, nx, device, dtype, m.anchor_grid._version)
+    if key not in cache:
+        if len(cache) >= 64:  # too many input shapes, start over
+            cache.clear()
+        grid = m._make_grid(nx, ny).to(device, dtype)  # (1,1,ny,nx,2)
+        s = float(m.stride[i])
+        a = m.anchor_grid[i].view(1, m.na, 1, 1, 2).to(device, dtype)
+        q = torch.cat((torch.zeros_like(a), 4 * a), -1)  # (1,na,1,1,4)
+        g = torch.tensor((2 * s, 2 * s, 0, 0), device=device, dtype=dtype)
+        b = torch.cat(((grid - 0.5) * s, torch.zeros_like(grid)), -1)  # (1,1,ny,nx,4)
+        cache[key] = grid, q, g, b
+    return cache[key]
+
+
 class Detect(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
@@ -49,12 +74,10 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
                 y = x[i].sigmoid()
                 if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    y[..., :4] = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                 else:
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
                     xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
@@ -127,12 +150,10 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
 
                 y = x[i].sigmoid()
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                y[..., :4] = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                 z.append(y.view(bs, -1, self.no))
 
         return x if self.training else (torch.cat(z, 1), x)
@@ -147,13 +168,11 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
 
                 y = x[i].sigmoid()
                 if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    y[..., :4] = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                 else:
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
                     xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
@@ -261,8 +280,7 @@ class IKeypoint(nn.Module):
             x_kpt = x[i][..., 6:]
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
                 kpt_grid_x = self.grid[i][..., 0:1]
                 kpt_grid_y = self.grid[i][..., 1:2]
 
@@ -272,8 +290,7 @@ class IKeypoint(nn.Module):
                     y = x_det.sigmoid()
 
                 if self.inplace:
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].view(1, self.na, 1, 1, 2) # wh
+                    xywh = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                     if self.nkpt != 0:
                         x_kpt[..., 0::3] = (x_kpt[..., ::3] * 2. - 0.5 + kpt_grid_x.repeat(1,1,1,1,17)) * self.stride[i]  # xy
                         x_kpt[..., 1::3] = (x_kpt[..., 1::3] * 2. - 0.5 + kpt_grid_y.repeat(1,1,1,1,17)) * self.stride[i]  # xy
@@ -289,14 +306,13 @@ class IKeypoint(nn.Module):
                         #x_kpt[..., 1::3] = (((x_kpt[..., 1::3].sigmoid() * 4.) ** 2 - 8.) * self.anchor_grid[i][...,1].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_y.repeat(1,1,1,1,17) * self.stride[i]  # xy
                         x_kpt[..., 2::3] = x_kpt[..., 2::3].sigmoid()
 
-                    y = torch.cat((xy, wh, y[..., 4:], x_kpt), dim = -1)
+                    y = torch.cat((xywh, y[..., 4:], x_kpt), dim = -1)
 
                 else:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    xywh = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                     if self.nkpt != 0:
                         y[..., 6:] = (y[..., 6:] * 2. - 0.5 + self.grid[i].repeat((1,1,1,1,self.nkpt))) * self.stride[i]  # xy
-                    y = torch.cat((xy, wh, y[..., 4:]), -1)
+                    y = torch.cat((xywh, y[..., 4:]), -1)
 
                 z.append(y.view(bs, -1, self.no))
 
@@ -345,13 +361,11 @@ class IAuxDetect(nn.Module):
             x[i+self.nl] = x[i+self.nl].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
 
                 y = x[i].sigmoid()
                 if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    y[..., :4] = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                 else:
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
                     xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
@@ -371,13 +385,11 @@ class IAuxDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
 
                 y = x[i].sigmoid()
                 if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                    y[..., :4] = torch.addcmul(b, y[..., :4], torch.addcmul(g, y[..., :4], q))  # xy, wh
                 else:
                     xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
                     wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].data  # wh
@@ -474,8 +486,7 @@ class IBin(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                self.grid[i], q, g, b = decode_terms(self, i, nx, ny, x[i].device, x[i].dtype)
 
                 y = x[i].sigmoid()
                 y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
@@ -580,26 +591,50 @@ class Model(nn.Module):
 
     def forward(self, x, augment=False, profile=False):
         if augment:
-            img_size = x.shape[-2:]  # height, width
-            s = [1, 0.83, 0.67]  # scales
-            f = [None, 3, None]  # flips (2-ud, 3-lr)
-            y = []  # outputs
-            for si, fi in zip(s, f):
-                xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
-                yi = self.forward_once(xi)[0]  # forward
-                # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-                yi[..., :4] /= si  # de-scale
-                if fi == 2:
-                    yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
-                elif fi == 3:
-                    yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
-                y.append(yi)
-            return torch.cat(y, 1), None  # augmented inference, train
+            return self.forward_augment(x), None  # augmented inference, train
         else:
             return self.forward_once(x, profile)  # single-scale inference, train
 
+    def forward_augment(self, x):
+        # Test-time augmentation over the (scale, flip) views in tta_scales, tta_flips (2-ud, 3-lr, 0/None none).
+        # Views padded to the same gs-multiple shape run as one batch. Smaller views are padded to the largest shape
+        # if they fill at least tta_fill of it (default 0.6 on CUDA, where fewer passes pay off, and 1.0 on CPU)
+        img_size = x.shape[-2:]  # height, width
+        s, f, fill = getattr(self, 'tta_scales', None), getattr(self, 'tta_flips', None), getattr(self, 'tta_fill', None)
+        if s is None:
+            s, f = (1, 0.83, 0.67), (None, 3, None) if f is None else f  # scales, flips
+        elif f is None:
+            f = [None] * len(s)  # scales only, no flips
+        if len(s) != len(f):
+            raise ValueError(f'{len(s)} test-time augmentation scales {s} but {len(f)} flips {f}')
+        if fill is None:
+            fill = 0.6 if x.is_cuda else 1.0
+        gs, bs = int(self.stride.max()), x.shape[0]
+
+        views = [scale_img(x.flip(fi) if fi else x, si, gs=gs) for si, fi in zip(s, f)]
+        h, w = max(v.shape[2] for v in views), max(v.shape[3] for v in views)
+        groups = {}  # padded shape: view indices
+        for j, v in enumerate(views):
+            if v.shape[2] * v.shape[3] >= fill * h * w:
+                views[j] = F.pad(v, [0, w - v.shape[3], 0, h - v.shape[2]], value=0.447)  # value = imagenet mean
+            groups.setdefault(views[j].shape[2:], []).append(j)
+
+        y = [None] * len(views)  # outputs
+        for i in groups.values():
+            yi = self.forward_once(torch.cat([views[j] for j in i]))[0]  # forward
+            yi = yi.view(len(i), bs, *yi.shape[1:])  # (views,bs,anchors,no)
+            yi[..., :4] /= torch.tensor([s[j] for j in i], device=yi.device, dtype=yi.dtype).view(-1, 1, 1, 1)  # de-scale
+            ud, lr = (torch.tensor([f[j] == k for j in i], device=yi.device).view(-1, 1, 1) for k in (2, 3))
+            yi[..., 1] = torch.where(ud, img_size[0] - yi[..., 1], yi[..., 1])  # de-flip ud
+            yi[..., 0] = torch.where(lr, img_size[1] - yi[..., 0], yi[..., 0])  # de-flip lr
+            for j, yj in zip(i, yi):
+                y[j] = yj
+        return torch.cat(y, 1)
+
     def forward_once(self, x, profile=False):
         y, dt = [], []  # outputs
+        if not hasattr(self.model[-1], 'release'):  # models saved before release lists
+            set_release(self.model)
         for m in self.model:
             if m.f != -1:  # if not from previous layer
                 x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
@@ -625,6 +660,8 @@ class Model(nn.Module):
             x = m(x)  # run
             
             y.append(x if m.i in self.save else None)  # save output
+            for j in m.release:  # free saved outputs after their last use
+                y[j] = None
 
         if profile:
             print('%.1fms total' % sum(dt))
@@ -810,9 +847,74 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         if i == 0:
             ch = []
         ch.append(c2)
+    set_release(layers)
     return nn.Sequential(*layers), sorted(save)
 
 
+def set_tta(model, scales=None, flips=None, fill=None):
+    # Sets the test-time augmentation views of every Model in model, a Model or an Ensemble of them
+    models = [m for m in model.modules() if isinstance(m, Model)]
+    if not models:  # i.e. TracedModel
+        logger.warning(f'WARNING: {type(model).__name__} ignores test-time augmentation, use --no-trace')
+    if scales is not None and flips is not None and len(scales) != len(flips):
+        raise ValueError(f'{len(scales)} test-time augmentation scales {scales} but {len(flips)} flips {flips}')
+    for m in models:
+        m.tta_scales, m.tta_flips, m.tta_fill = scales, flips, fill
+
+
+def set_release(layers):
+    # Attach to every layer the list of saved outputs it is the last consumer of, forward_once() frees them after it
+    last = {}  # saved output index: index of its last consumer
+    for m in layers:
+        for j in ([m.f] if isinstance(m.f, int) else m.f):
+            if j != -1:
+                last[j % m.i] = m.i
+    for m in layers:
+        m.release = [j for j, i in last.items() if i == m.i]
+
+
+def profile_memory(cfg='cfg/deploy/*.yaml', img_size=1280, batch_size=1, device=''):
+    # Peak inference memory of every cfg with saved outputs kept to the end vs released after their last use. Example:
+    #     from models.yolo import *; profile_memory()
+    device = select_device(device)
+    cuda = device.type != 'cpu'
+    print(f"\n{'cfg':>20s}{'saved kept (MB)':>17s}{'released (MB)':>15s}" +
+          (f"{'CUDA peak kept (MB)':>21s}{'released (MB)':>15s}" if cuda else '') + f"{'identical':>11s}")
+    for f in sorted(glob.glob(cfg)):
+        model = Model(f).to(device).eval()
+        x = torch.rand(batch_size, 3, img_size, img_size, device=device)
+        size = {}  # output bytes per layer
+        hooks = [m.register_forward_hook(lambda m, i, o: size.__setitem__(
+            m.i, o.numel() * o.element_size() if isinstance(o, torch.Tensor) else 0)) for m in model.model]
+        release = [m.release for m in model.model]
+
+        y, held, peak = [], [], []  # outputs, MB held by saved outputs, CUDA peak MB
+        for keep in True, False:
+            for m, r in zip(model.model, release):
+                m.release = [] if keep else r
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+            with torch.no_grad():
+                y.append(model(x)[0])
+            if cuda:
+                peak.append(torch.cuda.max_memory_allocated(device) / 1E6)
+
+            # peak bytes held by saved outputs, simulated from the output sizes
+            alive, b = {}, 0
+            for m in model.model:
+                if m.i in model.save:
+                    alive[m.i] = size[m.i]
+                b = max(b, sum(alive.values()))
+                for j in m.release:
+                    alive.pop(j, None)
+            held.append(b / 1E6)
+        for h in hooks:
+            h.remove()
+        mb = ''.join(f'{p:{w}.1f}' for p, w in zip(held + peak, (17, 15, 21, 15)))
+        print(f'{Path(f).stem:>20s}{mb}{str(torch.equal(y[0], y[1])):>11s}')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolor-csp-c.yaml', help='model.yaml')
@@ -0,0 +1,63 @@
+# Dataset and loader tests on small generated image folders: python -m pytest tests
+
+import cv2
+import numpy as np
+import pytest
+
+from utils.datasets import LoadImagesPrefetch, random_perspective_matrix, warp_targets
+
+
+def folder(path, sizes):
+    # Write one image per (h, w) in sizes, returns the folder
+    for i, (h, w) in enumerate(sizes):
+        cv2.imwrite(str(path / f'{i:04d}.jpg'), np.full((h, w, 3), i % 255, dtype=np.uint8))
+    return str(path)
+
+
+def batches(dataset):
+    return [(paths, imgs.shape) for paths, imgs, img0s, _ in dataset]
+
+
+@pytest.mark.parametrize('rect', [False, True])
+def test_prefetch_full_batches(tmp_path, rect):
+    # A folder larger than prefetch comes out in full batches, not one image at a time
+    dataset = LoadImagesPrefetch(folder(tmp_path, [(48, 64)] * 100), img_size=64, batch_size=8, workers=4,
+                                 prefetch=16, rect=rect)
+    y = batches(dataset)
+    assert [len(p) for p, _ in y] == [8] * 12 + [4]
+    assert sorted(f for p, _ in y for f in p) == sorted(dataset.files)
+    assert all(s[0] == len(p) for p, s in y)
+
+
+def test_prefetch_rect_batches(tmp_path):
+    # detect.py --batch-size: on a folder of mixed aspect ratios larger than prefetch, rect batches reach batch_size
+    # and use the precomputed batch shapes, so warmup runs once per batch shape and not once per image
+    rng = np.random.default_rng(0)
+    sizes = [(int(h), int(w)) for h, w in rng.integers(16, 96, (150, 2))]
+    dataset = LoadImagesPrefetch(folder(tmp_path, sizes), img_size=64, stride=32, batch_size=8, workers=4,
+                                 prefetch=16, rect=True)
+    y = batches(dataset)
+    assert [len(p) for p, _ in y] == [8] * 18 + [6]
+    shapes = dict(zip(dataset.files, dataset.shapes))
+    assert all(s[2:] == shapes[f] for p, s in y for f in p)  # letterboxed to the batch shape
+    assert len({s for _, s in y}) <= len(set(dataset.shapes)) + 1  # + the smaller last batch
+    assert len(set(dataset.shapes)) > 1  # not vacuous, several batch shapes
+
+
+@pytest.mark.parametrize('perspective', [0.0, 0.0005])
+def test_warp_targets_vectorized(perspective):
+    # The vectorized segment warp gives the boxes of the per-segment loop, for polygons inside, across and outside
+    # the image border
+    rng = np.random.default_rng(0)
+    segments = []
+    for c in rng.uniform(-200, 1480, (60, 2)):
+        a = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 100)))
+        r = rng.uniform(10, 150) * rng.uniform(0.5, 1, len(a))
+        segments.append((np.stack((np.cos(a) * r, np.sin(a) * r), 1) + c).astype(np.float32))
+    boxes = np.stack([np.concatenate((x.min(0), x.max(0))) for x in segments])  # unclipped xyxy
+    targets = np.concatenate((rng.integers(0, 80, (60, 1)), boxes), 1)
+    M, s, (width, height) = random_perspective_matrix((1280, 1280), degrees=10, translate=.1, scale=.5, shear=2,
+                                                      perspective=perspective, border=(-320, -320))
+    y0, y1 = (warp_targets(targets.copy(), list(segments), M, s, width, height, perspective, v) for v in (False, True))
+    assert y0.shape == y1.shape and 0 < len(y0) < len(targets)
+    np.testing.assert_allclose(y0, y1, atol=1e-6)
@@ -0,0 +1,135 @@
+# Label Studio upload tests against a local stand-in API server: python -m pytest tests
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip('requests')
+from utils.label_studio import api_session, import_tasks, project_images  # noqa: E402
+
+
+class StandIn:
+    # Minimal Label Studio API: GET /api/projects/1/tasks/?page=&page_size= and POST /api/projects/1/import.
+    # import_status lists the status of each successive import, accept_failed=True stores the tasks of a failed import
+    # (failure after commit). Pages past the last one are 404, max_page_size caps the page_size of a request
+    def __init__(self, import_status=(), accept_failed=False, tasks_status=(), max_page_size=100, paginated=False):
+        self.import_status, self.tasks_status = list(import_status), list(tasks_status)
+        self.accept_failed, self.tasks, self.posts, self.gets = accept_failed, [], 0, 0
+        self.max_page_size, self.paginated = max_page_size, paginated  # paginated: {'tasks', 'total'} responses
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                stand_in.gets += 1
+                status = stand_in.tasks_status.pop(0) if stand_in.tasks_status else 200
+                if status != 200:
+                    return self.reply(status, {'detail': 'error'})
+                query = parse_qs(urlparse(self.path).query)
+                page, size = int(query.get('page', [1])[0]), int(query.get('page_size', [100])[0])
+                size = min(size, stand_in.max_page_size)
+                tasks = stand_in.tasks[(page - 1) * size:page * size]
+                if page > 1 and not tasks:
+                    return self.reply(404, {'detail': 'Invalid page.'})
+                self.reply(200, {'tasks': tasks, 'total': len(stand_in.tasks)} if stand_in.paginated else tasks)
+
+            def do_POST(self):
+                stand_in.posts += 1
+                tasks = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status = stand_in.import_status.pop(0) if stand_in.import_status else 201
+                if status == 201 or stand_in.accept_failed:
+                    stand_in.tasks += tasks
+                self.reply(status, {'task_count': len(tasks)} if status == 201 else {'detail': 'error'})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def payloads(n):
+    return [{'data': {'image': f'http://0.0.0.0:1212/run/images/{i}.jpg'}, 'predictions': []} for i in range(n)]
+
+
+@pytest.fixture
+def server(request):
+    s = StandIn(**getattr(request, 'param', {}))
+    yield s
+    s.close()
+
+
+@pytest.mark.parametrize('server', [dict(import_status=[502], accept_failed=True)], indirect=True)
+def test_import_5xx_after_commit_is_not_duplicated(server):
+    done, error = import_tasks(api_session('token', retries=3), server.url, 1, payloads(3), backoff=0)
+    assert error is None and done == [0, 1, 2]
+    assert server.posts == 1  # the session did not retry the POST, the project listed the tasks already
+    assert len(server.tasks) == 3
+
+
+@pytest.mark.parametrize('server', [dict(import_status=[503, 502])], indirect=True)
+def test_import_5xx_before_commit_is_resubmitted(server):
+    done, error = import_tasks(api_session('token', retries=3), server.url, 1, payloads(3), backoff=0)
+    assert error is None and done == [0, 1, 2]
+    assert server.posts == 3
+    assert len(server.tasks) == 3
+
+
+@pytest.mark.parametrize('server', [dict(import_status=[500] * 10)], indirect=True)
+def test_import_gives_up_after_retries(server):
+    done, error = import_tasks(api_session('token', retries=2), server.url, 1, payloads(2), retries=2, backoff=0)
+    assert done == [] and error
+    assert server.posts == 3  # first import and 2 resubmissions
+    assert server.tasks == []
+
+
+@pytest.mark.parametrize('server', [dict(import_status=[400])], indirect=True)
+def test_import_rejected_is_not_resubmitted(server):
+    done, error = import_tasks(api_session('token', retries=3), server.url, 1, payloads(2), backoff=0)
+    assert done == [] and error
+    assert server.posts == 1
+
+
+@pytest.mark.parametrize('server', [dict(tasks_status=[503, 502])], indirect=True)
+def test_get_is_retried(server):
+    server.tasks = payloads(2)
+    session = api_session('token', retries=3)
+    session.adapters['http://'].max_retries.backoff_factor = 0
+    assert project_images(session, server.url, 1) == {p['data']['image'] for p in payloads(2)}
+    assert server.gets == 4  # page 1 three times, 404 past the last page
+
+
+@pytest.mark.parametrize('server', [dict(max_page_size=4), dict(max_page_size=4, paginated=True)], indirect=True)
+@pytest.mark.parametrize('n', [9, 12])
+def test_project_images_pages(server, n):
+    # Every page is read, including when the server caps page_size below the requested one
+    server.tasks = payloads(n)
+    images = project_images(api_session('token'), server.url, 1, page_size=1000)
+    assert images == {p['data']['image'] for p in payloads(n)}
+    assert server.gets == (n + 3) // 4 + 1
+
+
+@pytest.mark.parametrize('server', [dict(import_status=[502], accept_failed=True, max_page_size=2)], indirect=True)
+def test_import_5xx_after_commit_large_project(server):
+    # The committed tasks are on later pages of a project with earlier tasks, none is imported twice
+    server.tasks = payloads(7)[:4]
+    tasks = payloads(7)[4:]
+    done, error = import_tasks(api_session('token', retries=3), server.url, 1, tasks, backoff=0)
+    assert error is None and done == [0, 1, 2]
+    assert server.posts == 1
+    assert len(server.tasks) == 7
@@ -0,0 +1,132 @@
+# NMS engine parity tests, the numpy and batched engines against the per-image torchvision loop: python -m pytest tests
+
+import pytest
+import torch
+
+pytest.importorskip('torchvision')
+from utils.general import box_iou, non_max_suppression, xywh2xyxy  # noqa: E402
+
+
+def predictions(bs=2, na=2000, nc=5, seed=0):
+    # Random raw predictions (bs,na,nc+5) [xywh, obj, cls], sparse objectness so some boxes fall below conf_thres
+    g = torch.Generator().manual_seed(seed)
+    x = torch.rand(bs, na, nc + 5, generator=g)
+    x[..., :2] *= 640  # xy
+    x[..., 2:4] = x[..., 2:4] * 120 + 4  # wh
+    x[..., 4] **= 2  # obj
+    return x
+
+
+def grid(n, step=40, size=10):
+    # n non-overlapping (n,4) xywh boxes on a square grid
+    k = int(n ** 0.5) + 1
+    i = torch.arange(n)
+    return torch.stack(((i % k) * step + step / 2, (i // k) * step + step / 2,
+                        torch.full((n,), size), torch.full((n,), size)), 1).float()
+
+
+def run(x, backend, batched=False, **kwargs):
+    return non_max_suppression(x.clone(), backend=backend, batched=batched, **kwargs)
+
+
+def assert_parity(x, **kwargs):
+    # Returns the torchvision output after checking the numpy and batched engines match it image by image
+    y = run(x, 'torchvision', **kwargs)
+    assert len(y) == x.shape[0]
+    for engine in run(x, 'numpy', **kwargs), run(x, 'torchvision', batched=True, **kwargs):
+        assert len(engine) == len(y)
+        for a, b in zip(y, engine):
+            assert a.shape == b.shape
+            torch.testing.assert_close(a, b, rtol=0, atol=1e-4)
+    return y
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'agnostic': True}, {'multi_label': True},
+                                    {'multi_label': True, 'agnostic': True}, {'classes': [0, 3]},
+                                    {'conf_thres': 0.001, 'iou_thres': 0.65}], ids=str)
+def test_parity(kwargs):
+    y = assert_parity(predictions(), **kwargs)
+    assert all(len(d) for d in y)  # not vacuous
+    if 'classes' in kwargs:
+        assert all(set(d[:, 5].tolist()) <= {0., 3.} for d in y)
+    if 'agnostic' in kwargs:  # no two kept boxes overlap, whatever their class
+        for d in y:
+            assert (box_iou(d[:, :4], d[:, :4]).triu(1) <= kwargs.get('iou_thres', 0.45)).all()
+
+
+def test_single_class_parity():
+    y = assert_parity(predictions(nc=1))
+    assert all(len(d) for d in y)
+
+
+def test_labels_parity():
+    # Autolabelling: apriori labels (n,5) [cls, xywh] per image are kept with conf 1.0, one image without labels
+    x = predictions(bs=3)
+    labels = [torch.tensor([[1, 100, 100, 50, 50], [4, 300, 200, 80, 40]]).float(), torch.zeros((0, 5)),
+              torch.tensor([[2, 500, 500, 60, 60]]).float()]
+    y = assert_parity(x, labels=labels)
+    for d, l in zip(y, labels):
+        assert (d[:, 4] == 1.0).sum() >= len(l)
+
+
+def test_max_det():
+    # 400 non-overlapping boxes above threshold, only the 300 most confident are kept
+    x = torch.zeros(1, 400, 6)
+    x[0, :, :4] = grid(400)
+    x[0, :, 4] = torch.randperm(400, generator=torch.Generator().manual_seed(0)).float() / 400 * 0.5 + 0.4
+    x[0, :, 5] = 1.0
+    y = assert_parity(x)
+    assert len(y[0]) == 300
+    assert y[0][:, 4].min() >= x[0, :, 4].sort(descending=True).values[299]
+
+
+def test_max_nms():
+    # 30000 confident copies of one box and 10000 less confident non-overlapping boxes: only the 30000 most confident
+    # candidates enter NMS, so a single detection remains
+    x = torch.zeros(1, 40000, 6)
+    x[0, :30000, :4] = torch.tensor([2000., 2000., 50., 50.])
+    x[0, :30000, 4] = 0.9 + torch.arange(30000).float() / 30000 * 0.09
+    x[0, 30000:, :4] = grid(10000, step=20, size=5)
+    x[0, 30000:, 4] = 0.5
+    x[0, :, 5] = 1.0
+    y = assert_parity(x)
+    assert len(y[0]) == 1
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'multi_label': True}, {'labels': [torch.zeros((0, 5))] * 2}], ids=str)
+def test_empty(kwargs):
+    for x in torch.zeros(2, 0, 10), predictions(na=100) * torch.tensor([1.] * 4 + [0.1] + [1.] * 5):
+        y = assert_parity(x, **kwargs)  # no anchors, all below conf_thres
+        assert [d.shape for d in y] == [(0, 6)] * 2
+
+
+def test_empty_image_in_batch():
+    x = predictions(bs=3)
+    x[1, :, 4] = 0  # image without candidates
+    y = assert_parity(x)
+    assert len(y[0]) and not len(y[1]) and len(y[2])
+
+
+def test_batched_iou_tolerance():
+    # The batched engine suppresses the float32 class-offset boxes of the loop with IoU computed in float64, so a pair
+    # is kept or suppressed differently only if its IoU is within float32 rounding of iou_thres
+    g = torch.Generator().manual_seed(0)
+    bs, nc, iou_thres = 2000, 80, 0.45
+    wh = torch.rand(bs, 2, generator=g) * 200 + 10
+    xy = torch.rand(bs, 2, generator=g) * 3000 + 100
+    d = wh[:, 0] * (1 - iou_thres) / (1 + iou_thres) * (1 + (torch.rand(bs, generator=g) - 0.5) * 2e-4)  # x shift
+    x = torch.zeros(bs, 2, nc + 5)
+    x[:, 0, :4] = torch.cat((xy, wh), 1)
+    x[:, 1, :4] = torch.cat((xy + torch.stack((d, torch.zeros(bs)), 1), wh), 1)
+    x[:, 0, 4], x[:, 1, 4] = 0.9, 0.8
+    cls = torch.randint(0, nc, (bs,), generator=g)
+    x[torch.arange(bs), :, 5 + cls] = 1.0
+    kept = torch.tensor([len(d) for d in run(x, 'torchvision', iou_thres=iou_thres)])
+    kept_batched = torch.tensor([len(d) for d in run(x, 'torchvision', batched=True, iou_thres=iou_thres)])
+
+    b = (xywh2xyxy(x[:, :, :4].reshape(-1, 4)).view(bs, 2, 4) + cls[:, None, None] * 4096.).double()  # as the loop
+    iou = torch.stack([box_iou(b[i, :1], b[i, 1:])[0, 0] for i in range(bs)])  # exact IoU of the suppressed boxes
+    near = (iou - iou_thres).abs() < 1e-5
+    assert near.sum() > 10 and (kept == 1).any() and (kept == 2).any()  # not vacuous
+    assert near[kept != kept_batched].all()
+    assert (kept_batched[~near] == (iou[~near] <= iou_thres).long() + 1).all()  # exact decisions outside the band
@@ -0,0 +1,134 @@
+# Batched SimOTA parity tests, BatchedOTA against the per-image build_targets() loop: python -m pytest tests
+
+import pytest
+import torch
+import yaml
+
+from models.yolo import Detect, IAuxDetect, IBin
+from utils.loss import ComputeLossAuxOTA, ComputeLossBinOTA, ComputeLossOTA
+
+anchors = [[12, 16, 19, 36, 40, 28], [36, 75, 76, 55, 72, 146], [142, 110, 192, 243, 459, 401]]  # P3/8-P5/32
+nc, img_size = 4, 256
+heads = {ComputeLossOTA: (Detect, 3), ComputeLossBinOTA: (IBin, 3), ComputeLossAuxOTA: (IAuxDetect, 6)}  # head, ch
+
+
+def model(batched_ota, loss=ComputeLossOTA):
+    # Detection head of loss with the strides and grid-space anchors Model() would set, and the p5 hyperparameters
+    head, ch = heads[loss]
+    det = head(nc, anchors, ch=(8,) * ch)
+    det.stride = torch.tensor([8., 16., 32.])
+    det.anchors /= det.stride.view(-1, 1, 1)
+    m = torch.nn.Module()
+    m.model = torch.nn.Sequential(det)
+    with open('data/hyp.scratch.p5.yaml') as f:
+        m.hyp = {**yaml.safe_load(f), 'batched_ota': batched_ota}
+    m.gr = 1.0
+    return m
+
+
+def predictions(bs, seed=0, loss=ComputeLossOTA):
+    # Random raw predictions per layer (bs,na,ny,nx,no), lead head layers then auxiliary head layers for IAuxDetect
+    g = torch.Generator().manual_seed(seed)
+    head, ch = heads[loss]
+    no = head(nc, anchors, ch=(8,) * ch).no
+    return [torch.randn(bs, 3, img_size // s, img_size // s, no, generator=g) for s in (8, 16, 32) * (ch // 3)]
+
+
+def targets(counts, seed=0):
+    # Random targets(image,class,x,y,w,h) normalized xywh, counts[i] targets in image i
+    g = torch.Generator().manual_seed(seed)
+    t = []
+    for i, n in enumerate(counts):
+        xy = torch.rand(n, 2, generator=g) * 0.8 + 0.1
+        wh = torch.rand(n, 2, generator=g) * 0.3 + 0.02
+        cls = torch.randint(0, nc, (n, 1), generator=g).float()
+        t.append(torch.cat((torch.full((n, 1), float(i)), cls, xy, wh), 1))
+    return torch.cat(t, 0)
+
+
+def matches(y, i):
+    # Layer i matches as sorted unique rows (image, anchor, gj, gi, target(6), anchor wh(2)) and their counts.
+    # find_3_positive() repeats a grid cell for nearby targets and topk() breaks the resulting cost ties in no
+    # particular order, so the engines may pick different copies of a candidate: compare matches as multisets
+    b, a, gj, gi, t, anch = (x[i] for x in y)
+    if not b.numel():
+        return torch.zeros(0, 12), torch.zeros(0, dtype=torch.int64)
+    rows = torch.cat((torch.stack((b, a, gj, gi), 1).float(), t.float(), anch.float()), 1)
+    return torch.unique(rows, dim=0, return_counts=True)
+
+
+def assert_parity(p, t, loss=ComputeLossOTA):
+    # Same matches (image, anchor, grid cell, target, anchor) per layer and same loss with batched_ota on and off,
+    # for the lead head build_targets() and the auxiliary head build_targets2() of ComputeLossAuxOTA
+    imgs = torch.zeros(p[0].shape[0], 3, img_size, img_size)
+    loop, batched = loss(model(0, loss)), loss(model(1, loss))
+    assert loop.assigner is None and batched.assigner is not None
+    for build in 'build_targets', 'build_targets2':
+        if not hasattr(loop, build):
+            continue
+        y0, y1 = getattr(loop, build)(p[:loop.nl], t, imgs), getattr(batched, build)(p[:loop.nl], t, imgs)
+        for i in range(loop.nl):
+            (r0, n0), (r1, n1) = matches(y0, i), matches(y1, i)
+            assert r0.shape == r1.shape
+            torch.testing.assert_close(r0, r1)
+            assert torch.equal(n0, n1)
+        if build == 'build_targets':
+            y = y0
+
+    p0, p1 = [x.clone().requires_grad_() for x in p], [x.clone().requires_grad_() for x in p]
+    loss0, items0 = loop(p0, t, imgs)
+    loss1, items1 = batched(p1, t, imgs)
+    torch.testing.assert_close(loss0, loss1)
+    torch.testing.assert_close(items0, items1)
+    loss0.backward()
+    loss1.backward()
+    for a, b in zip(p0, p1):
+        torch.testing.assert_close(a.grad, b.grad)
+    return y
+
+
+def test_parity():
+    y = assert_parity(predictions(4), targets([2, 5, 1, 3]))
+    assert sum(len(b) for b in y[0])  # not vacuous
+
+
+def test_images_without_targets():
+    t = targets([0, 4, 0, 2])
+    y = assert_parity(predictions(4), t)
+    assert set(torch.cat(y[0]).tolist()) == {1, 3}
+
+
+def test_no_targets():
+    y = assert_parity(predictions(2), targets([0, 0]))
+    assert not any(len(b) for b in y[0])
+
+
+def test_more_targets_than_topk():
+    # 30 targets in one image, more than topk=10, and many candidates shared by several targets
+    t = targets([30, 3])
+    y = assert_parity(predictions(2), t)
+    matched = torch.cat(y[4])[:, 0]
+    assert (matched == 0).sum() >= 10
+
+
+def test_fewer_candidates_than_topk():
+    # A small target in the image corner has fewer candidates than topk, topk is clamped to the candidate count
+    t = torch.tensor([[0, 1, 0.01, 0.01, 0.02, 0.02], [1, 2, 0.5, 0.5, 0.2, 0.2]])
+    loss = ComputeLossOTA(model(1))
+    indices, _ = loss.find_3_positive(predictions(2), t)
+    assert 0 < sum(int((b == 0).sum()) for b, *_ in indices) < loss.assigner.topk
+    assert_parity(predictions(2), t)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parity_seeds(seed):
+    assert_parity(predictions(3, seed), targets([6, 0, 12], seed))
+
+
+@pytest.mark.parametrize('loss', [ComputeLossBinOTA, ComputeLossAuxOTA])
+@pytest.mark.parametrize('counts', [[2, 5, 1, 3], [0, 4, 0, 2], [30, 0], [0, 0]], ids=str)
+def test_bin_aux_parity(loss, counts):
+    # BatchedOTA with the bin-decoded candidates of ComputeLossBinOTA, and with topk=20 and the find_5_positive()
+    # candidates of the ComputeLossAuxOTA auxiliary head, including images without targets
+    y = assert_parity(predictions(len(counts), loss=loss), targets(counts), loss)
+    assert set(torch.cat(y[0]).tolist()) == {i for i, n in enumerate(counts) if n}
@@ -1,14 +1,20 @@
 # Dataset utils and dataloaders
 
+import atexit
 import glob
+import hashlib
 import logging
 import math
 import os
+import queue
 import random
 import shutil
+import tempfile
 import time
-from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, repeat
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
 
@@ -27,7 +33,7 @@ from torchvision.utils import save_image
 from torchvision.ops import roi_pool, roi_align, ps_roi_pool, ps_roi_align
 
 from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2boxes, \
-    resample_segments, clean_str
+    resample_segments, resample_segments_array, clean_str
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -42,9 +48,25 @@ for orientation in ExifTags.TAGS.keys():
         break
 
 
-def get_hash(files):
-    # Returns a single hash value of a list of files
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+def get_hash(files, stats=None):
+    # Returns a single hash value of a list of files, from their paths, sizes and modification times
+    h = hashlib.md5()
+    for f, s in zip(files, stats or file_stats(files)):
+        h.update(f'{f}{s}'.encode())
+    return h.hexdigest()
+
+
+def file_stats(files):
+    # Returns (size, mtime_ns) of every file, None if it does not exist
+    def stat(f):
+        try:
+            s = os.stat(f)
+            return s.st_size, s.st_mtime_ns
+        except OSError:
+            return None
+
+    with ThreadPool(32) as pool:  # stat is IO bound, threads help on network filesystems
+        return pool.map(stat, files, chunksize=1024)
 
 
 def exif_size(img):
@@ -71,6 +93,7 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
                                       hyp=hyp,  # augmentation hyperparameters
                                       rect=rect,  # rectangular training
                                       cache_images=cache,
+                                      cache_budget=getattr(opt, 'cache_budget', 0),
                                       single_cls=opt.single_cls,
                                       stride=int(stride),
                                       pad=pad,
@@ -80,35 +103,99 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
     sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
-    loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
-    # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
-    dataloader = loader(dataset,
+    # InfiniteDataLoader also with image_weights, the workers read the dataset.indices updates from shared memory
+    dataloader = InfiniteDataLoader(dataset,
                         batch_size=batch_size,
                         num_workers=nw,
                         sampler=sampler,
-                        pin_memory=True,
+                        pin_memory=not (augment and getattr(opt, 'pin_ring', 0)),  # train.py PinnedRing pins itself
                         collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
     return dataloader, dataset
 
 
 class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
-    """ Dataloader that reuses workers
+    """ Dataloader that reuses workers and keeps prefetching across epochs
 
-    Uses same syntax as vanilla DataLoader
+    Uses same syntax as vanilla DataLoader. The workers start on the first iteration and never stop, so the first
+    batches of the next epoch load while the last batches of this epoch and test.py run. Call set_epoch() once
+    before the first iteration when resuming, the sampler epoch then advances with every pass over the dataset
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         object.__setattr__(self, 'batch_sampler', _RepeatSampler(self.batch_sampler))
-        self.iterator = super().__iter__()
+        self.iterator = None
 
     def __len__(self):
         return len(self.batch_sampler.sampler)
 
     def __iter__(self):
+        if self.iterator is None:
+            self.iterator = super().__iter__()
         for i in range(len(self)):
             yield next(self.iterator)
 
+    def set_epoch(self, epoch):
+        self.batch_sampler.epoch = epoch
+
+
+class PinnedRing:  # host to device batch copies through a ring of preallocated pinned uint8 buffers
+    def __init__(self, device, n=3):
+        # n buffers, a pin thread fills a buffer once the device copy started from it has finished
+        self.device = device
+        self.buffers, self.events = [None] * n, [None] * n
+
+    def __call__(self, loader):
+        # Iterate loader with the batch images already on the device. The pageable to pinned copy runs in a pin
+        # thread (as DataLoader pin_memory does), the pinned to device copy is started async here
+        if self.device.type != 'cuda':
+            for imgs, *x in loader:
+                yield (imgs.to(self.device), *x)
+            return
+
+        free, ready = queue.Queue(), queue.Queue()  # buffer indices free to fill, (index, batch) or end/exception
+        for k in range(len(self.buffers)):
+            free.put(k)
+        Thread(target=self.pin, args=(loader, free, ready), daemon=True).start()
+        while True:
+            k, batch = ready.get()
+            if k is None:  # end of the loader, or an exception raised by it
+                if batch is not None:
+                    raise batch
+                return
+            imgs = self.buffers[k][:batch[0].numel()].view(batch[0].shape).to(self.device, non_blocking=True)
+            self.events[k] = torch.cuda.Event()
+            self.events[k].record()
+            free.put(k)
+            yield (imgs, *batch[1:])
+
+    def pin(self, loader, free, ready):
+        try:
+            for batch in loader:
+                imgs = batch[0]
+                k = free.get()
+                if self.events[k] is not None:
+                    self.events[k].synchronize()  # previous copy out of this buffer finished
+                if self.buffers[k] is None or self.buffers[k].numel() < imgs.numel() or self.buffers[k].dtype != imgs.dtype:
+                    self.buffers[k] = torch.empty(imgs.numel(), dtype=imgs.dtype).pin_memory()
+                self.buffers[k][:imgs.numel()].view(imgs.shape).copy_(imgs)
+                ready.put((k, batch))
+        except Exception as e:
+            ready.put((None, e))
+            return
+        ready.put((None, None))
+
+
+def stack_shared(tensors):
+    # torch.stack() straight into shared memory inside dataloader workers, so the batch is not copied again when sent
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        x = tensors[0]
+        storage = x._typed_storage() if hasattr(x, '_typed_storage') else x.storage()
+        if hasattr(storage, '_new_shared'):  # private torch API, otherwise the batch is moved to shared memory on send
+            out = x.new(storage._new_shared(sum(t.numel() for t in tensors))).resize_(len(tensors), *x.shape)
+    return torch.stack(tensors, 0, out=out)
+
 
 class _RepeatSampler(object):
     """ Sampler that repeats forever
@@ -117,11 +204,15 @@ class _RepeatSampler(object):
         sampler (Sampler)
     """
 
-    def __init__(self, sampler):
+    def __init__(self, sampler, epoch=0):
         self.sampler = sampler
+        self.epoch = epoch
 
     def __iter__(self):
         while True:
+            if hasattr(self.sampler.sampler, 'set_epoch'):  # DistributedSampler shuffle of the epoch being prefetched
+                self.sampler.sampler.set_epoch(self.epoch)
+            self.epoch += 1
             yield from iter(self.sampler)
 
 
@@ -205,6 +296,81 @@ class LoadImages:  # for inference
         return self.nf  # number of files
 
 
+class LoadImagesPrefetch(LoadImages):  # for batched inference
+    # Decodes and letterboxes images on a thread pool ahead of inference and yields batches of same-shape images
+    # as (paths, imgs, img0s, None) like LoadStreams. Videos in the source follow frame by frame as in LoadImages
+    # rect=True sorts images by aspect ratio and letterboxes each batch to one shape, as LoadImagesAndLabels does
+    def __init__(self, path, img_size=640, stride=32, batch_size=8, workers=8, prefetch=64, rect=False):
+        super().__init__(path, img_size, stride)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = max(prefetch, batch_size)  # maximum images decoded ahead of inference
+        self.ni = self.video_flag.count(False)  # number of images, listed before videos
+        self.shapes = [img_size] * self.ni  # letterbox new_shape of every image
+        self.rect = rect and self.ni > 0
+        if self.rect:
+            # Sort by aspect ratio (image headers only)
+            with ThreadPoolExecutor(workers) as pool:
+                s = np.array(list(pool.map(lambda f: exif_size(Image.open(f)), self.files[:self.ni])))  # wh
+            ar = s[:, 1] / s[:, 0]  # aspect ratio
+            irect = ar.argsort()
+            self.files[:self.ni] = [self.files[i] for i in irect]
+            ar = ar[irect]
+
+            # Set batch shapes, images of a batch are adjacent after sorting
+            nb = (self.ni + batch_size - 1) // batch_size  # number of batches
+            mini, maxi = ar[::batch_size], ar[np.minimum(np.arange(1, nb + 1) * batch_size, self.ni) - 1]
+            shapes = np.ones((nb, 2))
+            shapes[maxi < 1] = np.stack((maxi, np.ones(nb)), 1)[maxi < 1]
+            shapes[mini > 1] = np.stack((np.ones(nb), 1 / mini), 1)[mini > 1]
+            batch_shapes = np.ceil(shapes * img_size / stride).astype(int) * stride
+            self.shapes = [tuple(batch_shapes[i // batch_size]) for i in range(self.ni)]
+
+    def __iter__(self):
+        self.count = self.ni  # images are served by self.batches, videos by LoadImages.__next__()
+        self.mode = 'image'
+        self.batches = self.image_batches()
+        return self
+
+    def __next__(self):
+        batch = next(self.batches, None)
+        if batch is None:
+            return super().__next__()
+        paths, imgs, img0s = zip(*batch)
+        return list(paths), np.stack(imgs, 0), list(img0s), None
+
+    def load(self, path, shape):
+        # Read and letterbox one image, runs in a worker thread (OpenCV releases the GIL)
+        img0 = cv2.imread(path)  # BGR
+        assert img0 is not None, 'Image Not Found ' + path
+        img = letterbox(img0, shape, auto=not self.rect, stride=self.stride)[0]
+        img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, to 3x416x416
+        return path, img, img0
+
+    def image_batches(self):
+        # Yield lists of (path, img, img0) sharing one letterboxed shape, at most self.prefetch images in memory
+        files = zip(self.files[:self.ni], self.shapes)
+        groups, futures, n = {}, deque(), 0  # letterboxed shape: decoded images, loads in flight, images grouped
+        with ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                for f in islice(files, max(self.prefetch - n - len(futures), 0)):  # top up to the memory budget
+                    futures.append(pool.submit(self.load, *f))
+                if not futures:
+                    break
+                x = futures.popleft().result()
+                group = groups.setdefault(x[1].shape, [])
+                group.append(x)
+                n += 1
+                if len(group) == self.batch_size:
+                    n -= len(group)
+                    yield groups.pop(x[1].shape)
+                elif n > self.prefetch - self.batch_size:  # too many shapes pending, no room left for a full batch
+                    group = groups.pop(max(groups, key=lambda k: len(groups[k])))
+                    n -= len(group)
+                    yield group
+        yield from groups.values()
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe='0', img_size=640, stride=32):
         self.img_size = img_size
@@ -351,8 +517,10 @@ def img2label_paths(img_paths):
 
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
+    cache_version = 0.3  # labels cache version, columns in <cache>.columns, stats are (image size, mtime, label size, mtime)
+
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', cache_budget=0):
         self.img_size = img_size
         self.augment = augment
         self.hyp = hyp
@@ -388,10 +556,12 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
+        columns_path = Path(str(cache_path) + '.columns')  # memory-mapped label columns
         if cache_path.is_file():
             cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
+            if cache.get('version') != self.cache_version or not columns_path.is_dir() or \
+                    cache['hash'] != get_hash(self.label_files + self.img_files):  # changed
+                cache, exists = self.cache_labels(cache_path, prefix, cache), False  # re-cache changed files
         else:
             cache, exists = self.cache_labels(cache_path, prefix), False  # cache
 
@@ -402,24 +572,21 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
-        # Read cache
-        cache.pop('hash')  # remove hash
-        cache.pop('version')  # remove version
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
+        # Read cache, labels and segments are read-only views into memory-mapped columns shared by all workers
+        self.labels, shapes, self.segments = load_label_columns(columns_path)
         self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.img_files = cache['files']  # update
+        self.label_files = img2label_paths(self.img_files)  # update
         if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+            self.labels.data = np.array(self.labels.data)  # writeable copy
+            self.labels.data[:, 0] = 0
 
         n = len(shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
         nb = bi[-1] + 1  # number of batches
         self.batch = bi  # batch index of image
         self.n = n
-        self.indices = range(n)
+        self.indices = torch.arange(n).share_memory_().numpy()  # shared with the workers, update in place
 
         # Rectangular Training
         if self.rect:
@@ -447,80 +614,80 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
         self.imgs = [None] * n
-        if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
-            pbar.close()
-
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
+        if cache_images == 'disk':  # pre-resized images in 4GB shards next to the images, kept between runs
+            self.imgs = ImageArena(self, root=Path(self.img_files[0]).parent.as_posix() + '_cache',
+                                   budget=cache_budget * 1E9, shard_size=4E9, persist=True, prefix=prefix)
+            self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+        elif cache_images:  # one shared-memory arena per node, images that do not fit are decoded on demand
+            self.imgs = ImageArena(self, budget=cache_budget * 1E9, prefix=prefix)
+            self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+
+        # Paste-in sample bank, object cut-outs are harvested once instead of building 4-image mosaics per sample
+        self.sample_bank = None
+        if augment and hyp.get('paste_in', 0) and hyp.get('paste_in_bank', 0):
+            self.sample_bank = SampleBank(self, n=int(hyp['paste_in_bank']), path=cache_path.with_suffix('.samples'),
+                                          prefix=prefix)
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', cache=None):
+        # Cache dataset labels, check images and read shapes. Files whose size and modification time did not change
+        # since the previous cache are reused, the others are verified in chunks across a process pool
+        x = {}  # im_file: [labels, shape, segments, stat]
         nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
+        columns_path = Path(str(path) + '.columns')
+        old = {}  # im_file: index in the previous cache
+        if cache and cache.get('version') == self.cache_version and columns_path.is_dir():
+            old = {f: i for i, f in enumerate(cache['files'])}
+            old_labels, old_shapes, old_segments = load_label_columns(columns_path)
+        stats = list(zip(file_stats(self.img_files), file_stats(self.label_files)))  # (image stat, label stat)
+        stats = [(*(a or (-1, -1)), *(b or (-1, -1))) for a, b in stats]  # (image size, mtime, label size, mtime)
+        todo = []  # (image, label, prefix) to verify
+        for im_file, lb_file, stat in zip(self.img_files, self.label_files, stats):
+            i = old.get(im_file)
+            if i is not None and tuple(cache['stats'][i]) == stat:  # unchanged
+                x[im_file] = [np.array(old_labels[i]), old_shapes[i], [np.array(s) for s in old_segments[i]], stat]
+                if stat[2] < 0:
                     nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+                else:
+                    nf += 1  # label found
+                    ne += not len(x[im_file][0])  # label empty
+            else:
+                todo.append((im_file, lb_file, prefix))
+
+        if todo:
+            stat = dict(zip(self.img_files, stats))
+            nw = min(os.cpu_count(), 16)  # number of workers
+            with Pool(nw) as pool:
+                pbar = tqdm(pool.imap(verify_image_label, todo, chunksize=max(1, min(1024, len(todo) // (nw * 4)))),
+                            desc='Scanning images', total=len(todo))
+                for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if msg:
+                        print(msg)
+                    if l is not None:
+                        x[im_file] = [l, shape, segments, stat[im_file]]
+                    pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
+                                f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted ({len(x)}/{len(stats)} reused or verified)"
+                pbar.close()
+            x = {f: x[f] for f in self.img_files if f in x}  # dataset order
 
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
-        torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
-        return x
+        labels, shapes, segments, file_stat = zip(*x.values()) if x else ((), (), (), ())
+        save_label_columns(columns_path, labels, shapes, segments)
+        cache = {'files': list(x.keys()),
+                 'stats': np.array(file_stat, dtype=np.int64).reshape(-1, 4),
+                 'hash': get_hash(self.label_files + self.img_files,
+                                  [(s[2], s[3]) if s[2] >= 0 else None for s in stats] +
+                                  [(s[0], s[1]) if s[0] >= 0 else None for s in stats]),
+                 'results': (nf, nm, ne, nc, len(stats)),
+                 'version': self.cache_version}  # cache version
+        torch.save(cache, path)  # save for next time
+        logging.info(f'{prefix}New cache created: {path} ({len(todo)} of {len(stats)} files verified)')
+        return cache
 
     def __len__(self):
         return len(self.img_files)
@@ -545,7 +712,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             shapes = None
 
             # MixUp https://arxiv.org/pdf/1710.09412.pdf
-            if random.random() < hyp['mixup']:
+            if random.random() < hyp['mixup'] and not hyp.get('gpu_augment', 0):  # GPUAugment mixes within the batch
                 if random.random() < 0.8:
                     img2, labels2 = load_mosaic(self, random.randint(0, len(self.labels) - 1))
                 else:
@@ -567,9 +734,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
+        gpu = self.augment and hyp.get('gpu_augment', 0)  # perspective, hsv and flips left to GPUAugment
         if self.augment:
             # Augment imagespace
-            if not mosaic:
+            if not mosaic and not gpu:
                 img, labels = random_perspective(img, labels,
                                                  degrees=hyp['degrees'],
                                                  translate=hyp['translate'],
@@ -581,22 +749,26 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #img, labels = self.albumentations(img, labels)
 
             # Augment colorspace
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not gpu:
+                augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Apply cutouts
             # if random.random() < 0.9:
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
+                if self.sample_bank is not None:
+                    sample_labels, sample_images, sample_masks = self.sample_bank.draw(30)
+                else:
+                    sample_labels, sample_images, sample_masks = [], [], [] 
+                    while len(sample_labels) < 30:
+                        sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+                        sample_labels += sample_labels_
+                        sample_images += sample_images_
+                        sample_masks += sample_masks_
+                        #print(len(sample_labels))
+                        if len(sample_labels) == 0:
+                            break
                 labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
 
         nL = len(labels)  # number of labels
@@ -605,7 +777,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # normalized height 0-1
             labels[:, [1, 3]] /= img.shape[1]  # normalized width 0-1
 
-        if self.augment:
+        if self.augment and not gpu:
             # flip up-down
             if random.random() < hyp['flipud']:
                 img = np.flipud(img)
@@ -633,7 +805,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         img, label, path, shapes = zip(*batch)  # transposed
         for i, l in enumerate(label):
             l[:, 0] = i  # add target image index for build_targets()
-        return torch.stack(img, 0), torch.cat(label, 0), path, shapes
+        return stack_shared(img), torch.cat(label, 0), path, shapes
 
     @staticmethod
     def collate_fn4(batch):
@@ -659,10 +831,243 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         for i, l in enumerate(label4):
             l[:, 0] = i  # add target image index for build_targets()
 
-        return torch.stack(img4, 0), torch.cat(label4, 0), path4, shapes4
+        return stack_shared(img4), torch.cat(label4, 0), path4, shapes4
+
+
+class ImageArena:  # resized images in memory-mapped uint8 shard files shared by DDP ranks and dataloader workers
+    def __init__(self, dataset, root=None, budget=0, shard_size=0, persist=False, prefix=''):
+        # root: directory of the shard files, default /dev/shm. budget: bytes of images to cache, 0 for half of the
+        # available RAM, or half of the free disk space if persist. shard_size: bytes per shard file, 0 for a single
+        # shard. persist: keep the files after exit, they are named after the dataset hash and img_size so a changed
+        # dataset or img_size builds a new cache, and the caches of older versions of the dataset are deleted
+        root = Path(root) if root else Path('/dev/shm') if os.path.isdir('/dev/shm') else Path(tempfile.gettempdir())
+        root.mkdir(parents=True, exist_ok=True)
+        self.suffix = f"_{dataset.img_size}{'_augment' if dataset.augment else ''}"
+        name = f'yolov7_{get_hash(dataset.img_files)}{self.suffix}'
+        self.root, self.name, self.index_path = root, name, root / f'{name}.index.npy'
+        if int(os.getenv('LOCAL_RANK', -1)) in (-1, 0):  # local rank 0 builds the cache of its node
+            self.remove_stale(prefix)
+            if not self.index_path.is_file():  # the index is written last
+                if persist:
+                    self.remove_superseded(prefix)
+                free = shutil.disk_usage(root).free
+                self.build(dataset, min(budget or (free if persist else available_memory()) / 2, free),
+                           shard_size or float('inf'), persist, prefix)
+        else:  # per-node barrier, the other local ranks wait for the index of local rank 0
+            t = time.time()
+            while not self.index_path.is_file():
+                if time.time() - t > 7200:
+                    raise TimeoutError(f'{prefix}No image cache index {self.index_path} from local rank 0 after 2h')
+                time.sleep(1)
+        self.index = np.load(self.index_path)  # shard, offset, h, w, h0, w0 per image, offset -1 if not cached
+        self.shards = self.map()
+        self.hw, self.hw0 = self.index[:, 2:4], self.index[:, 4:6]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):  # spawned workers map the shards again instead of receiving a pickled copy
+        return {k: None if k == 'shards' else v for k, v in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shards = self.map()
+
+    def __getitem__(self, i):
+        k, o, h, w = self.index[i, :4]
+        return None if o < 0 else self.shards[k][o:o + h * w * 3].reshape(h, w, 3)
+
+    def shard(self, k):
+        return self.root / f'{self.name}.{k}.arena'
+
+    def remove_stale(self, prefix=''):
+        # Delete the caches and partial shards left in root by processes that died (killed, OOM) before their atexit
+        # cleanup: shared-memory caches record their builder in a .owner file, partial files end in .<pid>.tmp
+        stale = []
+        for f in self.root.glob('yolov7_*.owner'):
+            if not pid_exists(int(f.read_text() or 0)):
+                stale += [x for x in self.root.glob(f"{f.name.split('.')[0]}.*") if not x.name.endswith('.tmp')]
+        stale += [f for f in self.root.glob('yolov7_*.tmp') if not pid_exists(int(f.name.split('.')[-2]))]
+        for f in stale:
+            f.unlink(missing_ok=True)
+        if stale:
+            print(f'{prefix}Removed {len(stale)} stale image cache files from {self.root}')
+
+    def remove_superseded(self, prefix=''):
+        # Delete the persisted caches of the same root, img_size and augment built from another version of the dataset
+        old = [f for f in self.root.glob(f'yolov7_*{self.suffix}.*') if f.name.split('.')[0] != self.name]
+        if old:
+            n = sum(f.stat().st_size for f in old)
+            for f in old:
+                f.unlink()
+            print(f'{prefix}Removed {len(old)} superseded image cache files ({n / 1E9:.1f}GB) from {self.root}')
+
+    def map(self):
+        # memory-map every shard read-only
+        return [np.memmap(self.shard(k), dtype=np.uint8, mode='r') if os.path.getsize(self.shard(k)) else None
+                for k in range(self.index[:, 0].max() + 1)]
+
+    def build(self, dataset, budget, shard_size, persist=False, prefix=''):
+        index = np.full((len(dataset.img_files), 6), -1, dtype=np.int64)
+        s = dataset.shapes  # wh
+        r = dataset.img_size / s.max(1)  # resize ratio of load_image()
+        nbytes = (s[:, 0] * r).astype(np.int64) * (s[:, 1] * r).astype(np.int64) * 3  # estimated resized size
+        picked = np.nonzero(np.cumsum(nbytes) <= budget)[0]
+
+        tmp = lambda k: self.shard(k).with_suffix(f'.{os.getpid()}.tmp')  # renamed when complete, builders do not clash
+        owner = self.root / f'{self.name}.owner'
+        if not persist:  # lets a later run remove this cache if the process dies without its atexit cleanup
+            owner.write_text(str(os.getpid()))
+        k, offset, total = 0, 0, 0
+        f = open(tmp(k), 'wb')
+        with ThreadPool(8) as pool:
+            pbar = tqdm(zip(picked, pool.imap(lambda i: load_image(dataset, i), picked)), total=len(picked))
+            for i, (img, (h0, w0), (h, w)) in pbar:
+                if total + img.nbytes > budget:
+                    continue
+                if offset and offset + img.nbytes > shard_size:  # next shard
+                    f.close()
+                    k, offset = k + 1, 0
+                    f = open(tmp(k), 'wb')
+                f.write(np.ascontiguousarray(img).data)
+                index[i] = k, offset, h, w, h0, w0
+                offset += img.nbytes
+                total += img.nbytes
+                pbar.desc = f'{prefix}Caching images ({total / 1E9:.1f}GB in {k + 1} shards in {self.root})'
+            pbar.close()
+        f.close()
+        index[:, 0] = index[:, 0].clip(0)
+        for j in range(k + 1):
+            os.replace(tmp(j), self.shard(j))
+        with open(tmp(0), 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp(0), self.index_path)
+        if not persist:  # freed once every process unmapped it
+            files = [self.index_path, owner] + [self.shard(j) for j in range(k + 1)]
+            atexit.register(lambda: [x.unlink() for x in files if x.exists()])
+        nc = (index[:, 1] >= 0).sum()
+        if nc < len(index):
+            print(f'{prefix}WARNING: {len(index) - nc} of {len(index)} images do not fit in the {budget / 1E9:.1f}GB '
+                  f'image cache and are decoded on demand')
+
+
+def pid_exists(pid):
+    # Returns True if a process with this pid runs on this host
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # another user's process
+        pass
+    return True
+
+
+def available_memory():
+    # Returns the available RAM in bytes
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):  # not available on this OS
+        return 8E9
+
+
+class LabelColumns:  # per-image read-only views into one concatenated label array
+    def __init__(self, data, index):
+        self.data, self.index = data, index  # labels of image i are data[index[i]:index[i + 1]]
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.index[i]:self.index[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class SegmentColumns:  # per-image lists of read-only segment views into one concatenated point array
+    def __init__(self, points, segment_index, point_index):
+        self.points = points  # segments of image i are j in segment_index[i]:segment_index[i + 1],
+        self.segment_index, self.point_index = segment_index, point_index  # points[point_index[j]:point_index[j + 1]]
+
+    def __len__(self):
+        return len(self.segment_index) - 1
+
+    def __getitem__(self, i):
+        p = self.point_index
+        return [self.points[p[j]:p[j + 1]] for j in range(self.segment_index[i], self.segment_index[i + 1])]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def save_label_columns(path, labels, shapes, segments):
+    # Save per-image labels, shapes and segments as concatenated .npy columns in directory path
+    path.mkdir(parents=True, exist_ok=True)
+    segments_flat = [s for x in segments for s in x]
+    columns = {'labels': np.concatenate([np.zeros((0, 5), dtype=np.float32), *labels], 0).astype(np.float32),
+               'label_index': np.cumsum([0] + [len(x) for x in labels], dtype=np.int64),
+               'shapes': np.array(shapes, dtype=np.int64).reshape(-1, 2),
+               'segments': np.concatenate([np.zeros((0, 2), dtype=np.float32), *segments_flat], 0).astype(np.float32),
+               'segment_index': np.cumsum([0] + [len(x) for x in segments], dtype=np.int64),
+               'point_index': np.cumsum([0] + [len(x) for x in segments_flat], dtype=np.int64)}
+    for k, v in columns.items():
+        f = path / f'{k}.npy'
+        with open(f.with_suffix('.tmp'), 'wb') as t:
+            np.save(t, v)
+        os.replace(f.with_suffix('.tmp'), f)  # columns still mapped by other processes keep the old file
+
+
+def load_label_columns(path):
+    # Memory-map the columns written by save_label_columns(), returns labels, shapes, segments
+    c = {k: np.load(path / f'{k}.npy', mmap_mode='r') for k in
+         ('labels', 'label_index', 'shapes', 'segments', 'segment_index', 'point_index')}
+    return LabelColumns(c['labels'], c['label_index']), np.array(c['shapes']), \
+        SegmentColumns(c['segments'], c['segment_index'], c['point_index'])
 
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
+def verify_image_label(args):
+    # Verify one image-label pair, returns im_file, labels, shape, segments, nm, nf, ne, nc, message
+    im_file, lb_file, prefix = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupted
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        return im_file, None, None, None, nm, nf, ne, nc, f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
@@ -709,6 +1114,8 @@ def load_mosaic(self, index):
     # loads images in a 4-mosaic
 
     labels4, segments4 = [], []
+    tiles = []  # (image crop, x, y) on the canvas, warped straight into the output with hyp fused_mosaic
+    fused = self.hyp.get('fused_mosaic', 0) and not self.hyp['copy_paste']
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -718,7 +1125,7 @@ def load_mosaic(self, index):
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img4 = None if fused else np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -731,7 +1138,10 @@ def load_mosaic(self, index):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        if fused:
+            tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))
+        else:
+            img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
         padw = x1a - x1b
         padh = y1a - y1b
 
@@ -748,6 +1158,8 @@ def load_mosaic(self, index):
     for x in (labels4[:, 1:], *segments4):
         np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
     # img4, labels4 = replicate(img4, labels4)  # replicate
+    if fused:
+        return warp_mosaic(tiles, (s * 2, s * 2), labels4, segments4, self.hyp, border=self.mosaic_border)
 
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
@@ -768,6 +1180,8 @@ def load_mosaic9(self, index):
     # loads images in a 9-mosaic
 
     labels9, segments9 = [], []
+    tiles = []  # (image crop, x, y) on the canvas, warped straight into the output with hyp fused_mosaic
+    fused = self.hyp.get('fused_mosaic', 0) and not self.hyp['copy_paste']
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
     for i, index in enumerate(indices):
@@ -776,7 +1190,7 @@ def load_mosaic9(self, index):
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img9 = None if fused else np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -808,12 +1222,18 @@ def load_mosaic9(self, index):
         segments9.extend(segments)
 
         # Image
-        img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        if fused:
+            tiles.append((img[y1 - pady:, x1 - padx:], x1, y1))
+        else:
+            img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
         hp, wp = h, w  # height, width previous
 
     # Offset
     yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
-    img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
+    if fused:
+        tiles = [(im, x - xc, y - yc) for im, x, y in tiles]
+    else:
+        img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
 
     # Concat/clip labels
     labels9 = np.concatenate(labels9, 0)
@@ -825,6 +1245,8 @@ def load_mosaic9(self, index):
     for x in (labels9[:, 1:], *segments9):
         np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
     # img9, labels9 = replicate(img9, labels9)  # replicate
+    if fused:
+        return warp_mosaic(tiles, (s * 2, s * 2), labels9, segments9, self.hyp, border=self.mosaic_border)
 
     # Augment
     #img9, labels9, segments9 = remove_background(img9, labels9, segments9)
@@ -891,6 +1313,91 @@ def load_samples(self, index):
     return sample_labels, sample_images, sample_masks
 
 
+class SampleBank:  # paste_in object cut-outs harvested once per dataset
+    def __init__(self, dataset, n=3000, max_bytes=2E9, refresh=0.1, path=None, prefix=''):
+        # n: maximum number of cut-outs, max_bytes: maximum memory of the cut-outs, refresh: probability that a draw
+        # harvests one more image into the bank (random eviction) so the bank keeps changing over the epochs
+        self.dataset = dataset
+        self.n, self.max_bytes, self.refresh = n, max_bytes, refresh
+        self.labels, self.images, self.masks = [], [], []  # class, BGR crop, single channel mask crop
+        self.nbytes = 0
+        self.candidates = [i for i, x in enumerate(dataset.segments) if len(x)]  # images with segments
+        key = [get_hash(dataset.label_files + dataset.img_files), n, dataset.img_size]
+
+        path = Path(path) if path else None
+        if path and path.is_file():
+            try:
+                with open(path, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache['hash'] == key:
+                    for x in zip(cache['labels'], cache['images'], cache['masks']):
+                        self.add(*x)
+                    logging.info(f'{prefix}Loaded {len(self.labels)} paste_in samples from {path}')
+                    return
+            except Exception as e:  # truncated or from an incompatible version, rebuild
+                logging.info(f'{prefix}WARNING: paste_in sample bank {path} is unreadable ({e}), rebuilding')
+                self.labels, self.images, self.masks, self.nbytes = [], [], [], 0
+
+        order = random.sample(self.candidates, len(self.candidates))
+        with ThreadPool(8) as pool:
+            pbar = tqdm(pool.imap(self.harvest, order), total=len(order))
+            for x in pbar:
+                for label, image, mask in zip(*x):
+                    self.add(label, image, mask)
+                pbar.desc = f'{prefix}Harvesting paste_in samples ({len(self.labels)}/{n}, {self.nbytes / 1E9:.1f}GB)'
+                if len(self.labels) >= n:
+                    break
+            pbar.close()
+        if path:
+            try:
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump({'hash': key, 'labels': self.labels, 'images': self.images, 'masks': self.masks}, f)
+                os.replace(tmp, path)  # a crash while dumping leaves no truncated bank behind
+                logging.info(f'{prefix}New paste_in sample bank created: {path}')
+            except Exception as e:
+                logging.info(f'{prefix}WARNING: paste_in sample bank directory {path.parent} is not writeable: {e}')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def harvest(self, index):
+        # cut-outs of all the segmented objects of one (resized) image
+        img, _, (h, w) = load_image(self.dataset, index)
+        labels, segments = self.dataset.labels[index].copy(), self.dataset.segments[index]
+        labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h)
+        segments = [xyn2xy(x, w, h) for x in segments]
+        sample_labels, sample_images, sample_masks = sample_segments(img, labels, segments, probability=1.0)
+        return sample_labels, sample_images, [np.ascontiguousarray(x[..., 0]) for x in sample_masks]
+
+    def add(self, label, image, mask):
+        # insert one cut-out, evicting random ones while the bank is full
+        nbytes = image.nbytes + mask.nbytes
+        while self.labels and (len(self.labels) >= self.n or self.nbytes + nbytes > self.max_bytes):
+            self.evict(random.randrange(len(self.labels)))
+        self.labels.append(label)
+        self.images.append(image)
+        self.masks.append(mask)
+        self.nbytes += nbytes
+
+    def evict(self, i):
+        # O(1) removal, the last cut-out takes the place of cut-out i
+        self.nbytes -= self.images[i].nbytes + self.masks[i].nbytes
+        for x in (self.labels, self.images, self.masks):
+            x[i] = x[-1]
+            x.pop()
+
+    def draw(self, k=30):
+        # k random cut-outs as (sample_labels, sample_images, sample_masks) for pastein()
+        if self.candidates and random.random() < self.refresh:
+            for x in zip(*self.harvest(random.choice(self.candidates))):
+                self.add(*x)
+        if not self.labels:
+            return [], [], []
+        i = random.choices(range(len(self.labels)), k=k)
+        return [self.labels[j] for j in i], [self.images[j] for j in i], [np.repeat(self.masks[j][..., None], 3, 2) for j in i]
+
+
 def copy_paste(img, labels, segments, probability=0.5):
     # Implement Copy-Paste augmentation https://arxiv.org/abs/2012.07177, labels as nx5 np.array(cls, xyxy)
     n = len(segments)
@@ -1019,13 +1526,31 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
     # targets = [cls, xyxy]
 
-    height = img.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = img.shape[1] + border[1] * 2
+    M, s, (width, height) = random_perspective_matrix(img.shape[:2], degrees, translate, scale, shear, perspective, border)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(img[:, :, ::-1])  # base
+    # ax[1].imshow(img2[:, :, ::-1])  # warped
+
+    return img, warp_targets(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Returns the random_perspective() matrix M of an image of shape hw, its scale and the output size (width, height)
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -1052,24 +1577,34 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return M, s, (width, height)
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(img[:, :, ::-1])  # base
-    # ax[1].imshow(img2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_targets(targets, segments, M, s, width, height, perspective=0.0, vectorized=True):
+    # Transform label coordinates with the random_perspective() matrix M of scale s into a width x height image,
+    # vectorized=False transforms the segments one by one (reference for profile_warp_targets())
     n = len(targets)
     if n:
         use_segments = any(x.any() for x in segments)
         new = np.zeros((n, 4))
-        if use_segments:  # warp segments
+        if use_segments and vectorized:  # warp all segments at once
+            # Transform the original points, then upsample: interpolating homogeneous coordinates and dividing
+            # afterwards equals transforming the upsampled points, at a fraction of the points
+            r = 3 if perspective else 2  # rows of M, homogeneous coordinate only for perspective
+            xy = np.concatenate(segments, 0) @ M[:r, :2].T + M[:r, 2]  # transform
+            xy = resample_segments_array(np.split(xy, np.cumsum([len(x) for x in segments])[:-1]))  # upsample
+            x, y = xy[..., 0], xy[..., 1]
+            if perspective:  # perspective rescale
+                x, y = x / xy[..., 2], y / xy[..., 2]
+
+            # segment2box() of every segment, clip
+            inside = (x >= 0) & (y >= 0) & (x <= width) & (y <= height)
+            box = np.stack((np.where(inside, x, np.inf).min(1), np.where(inside, y, np.inf).min(1),
+                            np.where(inside, x, -np.inf).max(1), np.where(inside, y, -np.inf).max(1)), 1)
+            box[~(inside & (x != 0)).any(1)] = 0
+            new[:len(box)] = box
+
+        elif use_segments:  # warp segments
             segments = resample_segments(segments)  # upsample
             for i, segment in enumerate(segments):
                 xy = np.ones((len(segment), 3))
@@ -1100,7 +1635,65 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
         targets = targets[i]
         targets[:, 1:5] = new[i]
 
-    return img, targets
+    return targets
+
+
+def profile_warp_targets(instances=(10, 50, 100, 300), n=20, perspective=0.0005):
+    # Benchmark warp_targets() per-segment loop against the vectorized pass on a mosaic with random polygons. Example:
+    #     from utils.datasets import *; profile_warp_targets()
+    print(f"\n{'instances':>10s}{'loop (ms)':>14s}{'vectorized (ms)':>17s}{'speedup':>10s}{'identical':>12s}")
+    for k in instances:
+        segments = []
+        for _ in range(k):  # star-shaped polygons with 10-100 points on a 1280x1280 mosaic
+            m = random.randint(10, 100)
+            a = np.sort(np.random.uniform(0, 2 * math.pi, m))
+            r = np.random.uniform(10, 100) * np.random.uniform(0.5, 1, m)
+            segments.append((np.stack((np.cos(a) * r, np.sin(a) * r), 1) + np.random.uniform(0, 1280, 2)).astype(np.float32))
+        targets = np.concatenate((np.random.randint(0, 80, (k, 1)), np.stack([segment2box(x, 1280, 1280) for x in segments])), 1)
+        M, s, (width, height) = random_perspective_matrix((1280, 1280), degrees=10, translate=.1, scale=.5, shear=2,
+                                                          perspective=perspective, border=(-320, -320))
+        dt, y = [], []
+        for vectorized in False, True:
+            t = time.time()
+            for _ in range(n):
+                out = warp_targets(targets.copy(), list(segments), M, s, width, height, perspective, vectorized)
+            dt.append((time.time() - t) * 1000 / n)
+            y.append(out)
+        identical = y[0].shape == y[1].shape and np.allclose(y[0], y[1], atol=1e-3)
+        print(f'{k:10}{dt[0]:14.4g}{dt[1]:17.4g}{dt[0] / dt[1]:10.3g}{str(identical):>12s}')
+
+
+def warp_mosaic(tiles, shape, targets, segments, hyp, border=(0, 0)):
+    # Fused mosaic + random_perspective(). tiles are (image crop, x, y) placed on a mosaic canvas of shape hw, each tile
+    # is warped straight into the output with the placement and the random_perspective() matrix composed, so the
+    # canvas is never built. Every tile only touches the bounding box of its warped corners
+    perspective = hyp['perspective']
+    M, s, (width, height) = random_perspective_matrix(shape, hyp['degrees'], hyp['translate'], hyp['scale'],
+                                                      hyp['shear'], perspective, border)
+    img = np.full((height, width, 3), 114, dtype=np.uint8)
+    for crop, x, y in tiles:
+        x1, y1 = max(x, 0), max(y, 0)  # clip to the canvas
+        x2, y2 = min(x + crop.shape[1], shape[1]), min(y + crop.shape[0], shape[0])
+        if x2 <= x1 or y2 <= y1:
+            continue
+        crop = crop[y1 - y:y2 - y, x1 - x:x2 - x]
+
+        xy = np.array([[x1, y1, 1], [x2, y1, 1], [x1, y2, 1], [x2, y2, 1]], dtype=np.float64) @ M.T  # warped corners
+        xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]
+        bx1, by1 = [max(math.floor(v), 0) for v in xy.min(0)]
+        bx2, by2 = min(math.ceil(xy[:, 0].max()), width), min(math.ceil(xy[:, 1].max()), height)
+        if bx2 <= bx1 or by2 <= by1:
+            continue
+
+        T = np.array([[1, 0, -bx1], [0, 1, -by1], [0, 0, 1]]) @ M @ np.array([[1, 0, x1], [0, 1, y1], [0, 0, 1]])
+        roi = img[by1:by2, bx1:bx2].copy()
+        if perspective:
+            roi = cv2.warpPerspective(crop, T, dsize=(bx2 - bx1, by2 - by1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+        else:  # affine
+            roi = cv2.warpAffine(crop, T[:2], dsize=(bx2 - bx1, by2 - by1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+        img[by1:by2, bx1:bx2] = roi
+
+    return img, warp_targets(targets, segments, M, s, width, height, perspective)
 
 
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
@@ -1215,6 +1808,129 @@ def pastein(image, labels, sample_labels, sample_images, sample_masks):
 
     return labels
 
+class GPUAugment:
+    # Batched augmentation on the training device for hyp gpu_augment: random_perspective() of the letterboxed
+    # (non-mosaic) images, mixup with the next image of the batch, HSV jitter and flips, each with per-image random
+    # parameters. Applied after collate_fn to the RGB batch, targets are (image, class, x, y, w, h) normalized
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    def __call__(self, imgs, targets, shapes):
+        # imgs (b,3,h,w) uint8 and targets on the training device, shapes from collate_fn (None for mosaics)
+        imgs = imgs.float()
+        warp = torch.tensor([x is not None for x in shapes], device=imgs.device)
+        if warp.any():
+            imgs, targets = self.perspective(imgs, targets, warp)
+        if self.hyp['mixup']:
+            imgs, targets = self.mixup(imgs, targets)
+        imgs = self.hsv(imgs)
+        imgs, targets = self.flip(imgs, targets)
+        return imgs, targets  # float 0-255
+
+    def perspective(self, imgs, targets, warp):
+        # random_perspective() (affine part) of the images where warp is True
+        hyp, d = self.hyp, imgs.device
+        b, _, h, w = imgs.shape
+        u = lambda *shape: torch.rand(*shape, device=d) * 2 - 1  # uniform -1, 1
+        a = u(b) * hyp['degrees'] * math.pi / 180  # rotation
+        s = 1.05 + u(b) * (hyp['scale'] + 0.05)  # scale uniform(1 - scale, 1.1 + scale)
+        sh = torch.tan(u(b, 2) * hyp['shear'] * math.pi / 180)  # shear
+        t = (0.5 + u(b, 2) * hyp['translate']) * torch.tensor([w, h], device=d)  # translation
+
+        M = torch.eye(3, device=d).repeat(b, 1, 1)
+        M[:, 0, 0], M[:, 0, 1] = s * torch.cos(a), s * torch.sin(a)  # cv2.getRotationMatrix2D()
+        M[:, 1, 0], M[:, 1, 1] = -s * torch.sin(a), s * torch.cos(a)
+        S = torch.eye(3, device=d).repeat(b, 1, 1)
+        S[:, 0, 1], S[:, 1, 0] = sh[:, 0], sh[:, 1]
+        C = torch.tensor([[1, 0, -w / 2], [0, 1, -h / 2], [0, 0, 1]], device=d)  # center
+        M = S @ M @ C
+        M[:, :2, 2] += t
+        M[~warp] = torch.eye(3, device=d)
+
+        # grid_sample() takes the output to input mapping in -1, 1 coordinates
+        N = torch.tensor([[2 / w, 0, -1], [0, 2 / h, -1], [0, 0, 1]], device=d)
+        theta = (N @ torch.inverse(M) @ torch.inverse(N))[warp, :2]
+        grid = F.affine_grid(theta, [len(theta), 3, h, w], align_corners=False)
+        imgs[warp] = F.grid_sample(imgs[warp] - 114, grid, align_corners=False) + 114  # border value 114
+
+        # warp boxes
+        j = targets[:, 0].long()
+        m = warp[j]
+        if m.any():
+            t = targets[m]
+            gain = torch.tensor([w, h, w, h], device=d)
+            box = xywh2xyxy(t[:, 2:6]) * gain
+            xy = torch.ones(len(t), 4, 3, device=d)
+            xy[..., :2] = box[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+            xy = xy @ M[j[m]].transpose(1, 2)
+            new = torch.cat((xy[..., :2].min(1)[0], xy[..., :2].max(1)[0]), 1)
+            new[:, [0, 2]] = new[:, [0, 2]].clamp(0, w)
+            new[:, [1, 3]] = new[:, [1, 3]].clamp(0, h)
+
+            # box_candidates()
+            w1, h1 = (box[:, 2] - box[:, 0]) * s[j[m]], (box[:, 3] - box[:, 1]) * s[j[m]]
+            w2, h2 = new[:, 2] - new[:, 0], new[:, 3] - new[:, 1]
+            ar = torch.max(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))  # aspect ratio
+            i = (w2 > 2) & (h2 > 2) & (w2 * h2 / (w1 * h1 + 1e-16) > 0.1) & (ar < 20)
+            t[:, 2:6] = xyxy2xywh(new / gain)
+            targets = torch.cat((targets[~m], t[i]), 0)
+        return imgs, targets
+
+    def mixup(self, imgs, targets):
+        # MixUp https://arxiv.org/pdf/1710.09412.pdf with the next image of the batch, its labels are added
+        d = imgs.device
+        b = imgs.shape[0]
+        m = torch.rand(b, device=d) < self.hyp['mixup']
+        if not m.any():
+            return imgs, targets
+        r = torch.from_numpy(np.random.beta(8.0, 8.0, b)).float().to(d)  # mixup ratio, alpha=beta=8.0
+        r[~m] = 1.0
+        nxt = (torch.arange(b, device=d) + 1) % b
+        imgs = imgs * r.view(-1, 1, 1, 1) + imgs[nxt] * (1 - r).view(-1, 1, 1, 1)
+        t = targets[m[(targets[:, 0].long() - 1) % b]].clone()  # labels of the images mixed into another one
+        t[:, 0] = (t[:, 0] - 1) % b
+        return imgs, torch.cat((targets, t), 0)
+
+    def hsv(self, imgs):
+        # augment_hsv() with per-image gains, imgs RGB 0-255
+        hyp, d = self.hyp, imgs.device
+        g = (torch.rand(imgs.shape[0], 3, 1, 1, device=d) * 2 - 1) * \
+            torch.tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']], device=d).view(1, 3, 1, 1) + 1  # random gains
+        x = imgs / 255
+        mx, i = x.max(1)
+        delta = mx - x.min(1)[0]
+        r, gr, bl = x.unbind(1)
+        hue = torch.stack(((gr - bl) / (delta + 1e-16) % 6, (bl - r) / (delta + 1e-16) + 2,
+                           (r - gr) / (delta + 1e-16) + 4), 1).gather(1, i.unsqueeze(1)).squeeze(1)
+        hue = torch.where(delta > 0, hue / 6, torch.zeros_like(hue))
+        sat = torch.where(mx > 0, delta / (mx + 1e-16), torch.zeros_like(mx))
+
+        hue = (hue * g[:, 0]) % 1
+        sat = (sat * g[:, 1]).clamp(0, 1)
+        val = (mx * g[:, 2]).clamp(0, 1)
+
+        # back to RGB
+        h6 = hue * 6
+        k = h6.floor().long() % 6
+        f = h6 - h6.floor()
+        p, q, t = val * (1 - sat), val * (1 - f * sat), val * (1 - (1 - f) * sat)
+        rgb = [torch.stack(c, 1).gather(1, k.unsqueeze(1)) for c in
+               ((val, q, p, p, t, val), (t, val, val, q, p, p), (p, p, t, val, val, q))]
+        return torch.cat(rgb, 1) * 255
+
+    def flip(self, imgs, targets):
+        # flip up-down and left-right
+        hyp, d = self.hyp, imgs.device
+        b = imgs.shape[0]
+        j = targets[:, 0].long()
+        for p, dim, col in ((hyp['flipud'], 2, 3), (hyp['fliplr'], 3, 2)):
+            if p:
+                m = torch.rand(b, device=d) < p
+                imgs = torch.where(m.view(-1, 1, 1, 1), imgs.flip(dim), imgs)
+                targets[m[j], col] = 1 - targets[m[j], col]
+        return imgs, targets
+
+
 class Albumentations:
     # YOLOv5 Albumentations class (optional, only used if package is installed)
     def __init__(self):
@@ -1,31 +1,32 @@
 # YOLOR general utils
 
+import atexit
 import glob
 import logging
 import math
 import os
 import platform
+import queue
 import random
 import re
 import subprocess
 import time
 from pathlib import Path
+from threading import Thread
 
 import cv2
 import numpy as np
-import pandas as pd
 import torch
 import torchvision
 import yaml
 
 from utils.google_utils import gsutil_getsize
 from utils.metrics import fitness
-from utils.torch_utils import init_torch_seeds
+from utils.torch_utils import init_torch_seeds, time_synchronized
 
 # Settings
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(min(os.cpu_count(), 8))  # NumExpr max threads
 
@@ -317,6 +318,26 @@ def resample_segments(segments, n=1000):
     return segments
 
 
+def resample_segments_array(segments, n=1000):
+    # Up-sample a list of (m,d) segments into one (k,n,d) array, resample_segments() in a single vectorized pass
+    m = np.array([len(x) for x in segments])  # points per segment
+    offset = np.cumsum(m) - m  # first point of every segment in the packed points
+    points = np.concatenate(segments, 0)
+    j = np.repeat(np.arange(len(m)), m + 1)  # segment of every point of the closed segments
+    k = np.arange(len(j)) - np.repeat(np.cumsum(m + 1) - (m + 1), m + 1)  # point index within its closed segment
+    closed = points[offset[j] + np.where(k == m[j], 0, k)]  # closed segments (first point repeated), packed
+    start = np.cumsum(m + 1) - (m + 1)
+
+    # One np.interp() per coordinate over the packed closed segments, sample positions never leave their segment
+    x = np.linspace(0, 1, n)[None] * m[:, None]  # sample positions along every closed segment
+    x += start[:, None]  # in the packed closed segments
+    xp = np.arange(len(closed))
+    out = np.empty((closed.shape[1], len(m), n))  # coordinate-major so every coordinate is contiguous
+    for c in range(closed.shape[1]):
+        out[c] = np.interp(x.ravel(), xp, closed[:, c]).reshape(len(m), n)
+    return out.transpose(1, 2, 0)
+
+
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     # Rescale coords (xyxy) from img1_shape to img0_shape
     if ratio_pad is None:  # calculate from img0_shape
@@ -606,13 +627,24 @@ def box_diou(box1, box2, eps: float = 1e-7):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), batched=False, backend='torchvision', soft=False, merge=False):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    backend='numpy' selects the NumPy engine for CPU-only hosts, the only backend supporting soft=True (Soft-NMS)
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
+    assert backend in ('torchvision', 'numpy'), f'unknown NMS backend {backend}'
+    assert backend == 'numpy' or not soft, 'Soft-NMS requires the numpy NMS backend'
+    if backend == 'numpy':  # CPU engine
+        return non_max_suppression_numpy(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                         soft=soft, merge=merge)
+    if batched:  # single NMS call for the whole batch
+        return non_max_suppression_batched(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                           merge=merge)
+
     nc = prediction.shape[2] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
@@ -623,7 +655,6 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
@@ -700,6 +731,247 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), merge=False):
+    """Runs Non-Maximum Suppression (NMS) on a batch of inference results with a single torchvision.ops.nms() call
+
+    Boxes are offset by class and image index, so one NMS replaces the per-image loop of non_max_suppression()
+    with the same outputs. Class-offset boxes are built in the input dtype as in non_max_suppression(), the image offset
+    and IoU are computed in float64 so large batches do not lose precision. A pair is kept or suppressed differently
+    only if its IoU is within float32 rounding of iou_thres (1e-5 bound, in practice exact ties), tests/test_nms.py
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+    xc = prediction[..., 4] > conf_thres  # candidates
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    redundant = True  # require redundant detections
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    xi = xc.nonzero(as_tuple=False)[:, 0]  # image index of every candidate
+    x = prediction[xc]  # candidates of all images, image-major
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(l) for l in labels):
+        l = torch.cat([l for l in labels if len(l)], 0)
+        li = torch.cat([torch.full((len(l),), i, device=x.device, dtype=xi.dtype) for i, l in enumerate(labels)], 0)
+        v = torch.zeros((len(l), nc + 5), device=x.device)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        xi, x = torch.cat((xi, li), 0), torch.cat((x, v.type_as(x)), 0)
+        n = x.shape[0]
+        k = torch.argsort(xi * n + torch.arange(n, device=x.device))  # labels follow their image's candidates
+        xi, x = xi[k], x[k]
+
+    # If none remain return empty detections
+    output = [torch.zeros((0, 6), device=prediction.device)] * bs
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    if nc == 1:
+        x[:, 5:] = x[:, 4:5]  # single class models have cls_conf 0.5, use obj_conf
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, xi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        k = conf.view(-1) > conf_thres
+        x, xi = torch.cat((box, conf, j.float()), 1)[k], xi[k]
+
+    # Filter by class
+    if classes is not None:
+        k = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[k], xi[k]
+
+    # Check shape
+    n = x.shape[0]  # number of boxes
+    if not n:  # no boxes
+        return output
+    counts = torch.bincount(xi, minlength=bs)  # boxes per image
+    if counts.max() > max_nms:  # excess boxes, keep the max_nms most confident of those images
+        k = torch.argsort(xi * 2 + (1 - x[:, 4].double()))  # image-major, confidence descending
+        rank = torch.empty_like(k)
+        rank[k] = torch.arange(n, device=x.device) - (counts.cumsum(0) - counts)[xi[k]]
+        k = rank < max_nms
+        x, xi = x[k], xi[k]
+        counts = counts.clamp(max=max_nms)
+
+    # Batched NMS
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    span = (boxes.max() - boxes.min()).double() + 1  # image offset, larger than any class-offset box extent
+    boxes = boxes.double() + xi[:, None].double() * span  # boxes (offset by class and image), exact in float64
+    i = torchvision.ops.nms(boxes, scores.double(), iou_thres)  # NMS, boxes sorted by score
+
+    # Limit detections per image
+    k = torch.argsort(xi[i] * len(i) + torch.arange(len(i), device=x.device))  # image-major, score order kept
+    i = i[k]
+    ni = torch.bincount(xi[i], minlength=bs)  # detections per image
+    i = i[torch.arange(len(i), device=x.device) - (ni.cumsum(0) - ni)[xi[i]] < max_det]
+
+    if merge:  # Merge NMS (boxes merged using weighted mean)
+        m = (counts[xi[i]] > 1) & (counts[xi[i]] < 3E3)
+        # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4), boxes of other images never overlap
+        iou = box_iou(boxes[i[m]], boxes) > iou_thres  # iou matrix
+        weights = iou * scores[None]  # box weights
+        x[i[m], :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+        if redundant:
+            k = torch.ones_like(i, dtype=torch.bool)
+            k[m] = iou.sum(1) > 1  # require redundancy
+            i = i[k]
+
+    return list(x[i].split(torch.bincount(xi[i], minlength=bs).tolist()))
+
+
+def nms_numpy(boxes, scores, iou_thres, max_det=300, soft=False, sigma=0.5, score_thres=0.001):
+    # Greedy NMS of (n,4) xyxy float32 boxes, same decisions as torchvision.ops.nms() on CPU
+    # Stops at max_det kept boxes. soft=True decays overlapping scores with a Gaussian penalty (Soft-NMS) and drops
+    # boxes under score_thres instead of discarding every overlap. Returns kept indices and (decayed) scores
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    scores = scores.copy() if soft else scores
+    order = np.argsort(-scores, kind='stable')  # score descending, ties in input order
+    keep = []
+    while order.size and len(keep) < max_det:
+        i, j = order[0], order[1:]
+        keep.append(i)
+        w = np.maximum(0, np.minimum(x2[i], x2[j]) - np.maximum(x1[i], x1[j]))
+        h = np.maximum(0, np.minimum(y2[i], y2[j]) - np.maximum(y1[i], y1[j]))
+        inter = w * h
+        iou = inter / (areas[i] + areas[j] - inter)
+        if soft:
+            scores[j] *= np.exp(-(iou * iou) / sigma)
+            j = j[scores[j] > score_thres]  # confidence cutoff
+            order = j[np.argsort(-scores[j], kind='stable')]
+        else:
+            order = j[iou <= iou_thres]
+    return np.array(keep, dtype=np.int64), scores
+
+
+def non_max_suppression_numpy(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                              multi_label=False, labels=(), soft=False, merge=False):
+    """Runs Non-Maximum Suppression (NMS) on inference results with a NumPy engine for CPU-only inference hosts
+
+    Same filtering and limits as non_max_suppression() without the torch indexing overhead on CPU.
+    soft=True applies Gaussian Soft-NMS, merge=True replaces kept boxes by the score-weighted mean of their overlaps.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    device = prediction.device
+    prediction = prediction.float().cpu().numpy()
+    nc = prediction.shape[2] - 5  # number of classes
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes into nms_numpy()
+    redundant = True  # require redundant detections
+    multi_label &= nc > 1  # multiple labels per box
+
+    output = [torch.zeros((0, 6), device=device)] * prediction.shape[0]
+    for xi, x in enumerate(prediction):  # image index, image inference
+        x = x[x[:, 4] > conf_thres]  # confidence
+
+        # Cat apriori labels if autolabelling
+        if labels and len(labels[xi]):
+            l = labels[xi].cpu().numpy()
+            v = np.zeros((len(l), nc + 5), dtype=np.float32)
+            v[:, :4] = l[:, 1:5]  # box
+            v[:, 4] = 1.0  # conf
+            v[range(len(l)), l[:, 0].astype(int) + 5] = 1.0  # cls
+            x = np.concatenate((x, v), 0)
+
+        # If none remain process next image
+        if not x.shape[0]:
+            continue
+
+        # Compute conf
+        if nc == 1:
+            x[:, 5:] = x[:, 4:5]  # single class models have cls_conf 0.5, use obj_conf
+        else:
+            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+        box = xywh2xyxy(x[:, :4])
+
+        # Detections matrix nx6 (xyxy, conf, cls)
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero()
+            x = np.concatenate((box[i], x[i, j + 5, None], j[:, None].astype(np.float32)), 1)
+        else:  # best class only
+            j = x[:, 5:].argmax(1)
+            conf = x[np.arange(len(j)), j + 5]
+            x = np.concatenate((box, conf[:, None], j[:, None].astype(np.float32)), 1)[conf > conf_thres]
+
+        # Filter by class
+        if classes is not None:
+            x = x[(x[:, 5:6] == np.array(classes)).any(1)]
+
+        # Check shape
+        n = x.shape[0]  # number of boxes
+        if not n:  # no boxes
+            continue
+        elif n > max_nms:  # excess boxes
+            x = x[np.argsort(-x[:, 4], kind='stable')[:max_nms]]  # sort by confidence
+
+        # NMS
+        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        boxes = x[:, :4] + c  # boxes (offset by class)
+        i, scores = nms_numpy(boxes, x[:, 4], iou_thres, max_det, soft=soft, score_thres=conf_thres)
+        x[:, 4] = scores  # decayed confidences if Soft-NMS
+        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
+            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+            b1, b2 = boxes[i, None], boxes[None]
+            inter = (np.minimum(b1[..., 2:], b2[..., 2:]) - np.maximum(b1[..., :2], b2[..., :2])).clip(0).prod(2)
+            area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            iou = inter / (area[i, None] + area[None] - inter) > iou_thres  # iou matrix
+            weights = iou * scores[None]  # box weights
+            x[i, :4] = weights @ x[:, :4] / weights.sum(1, keepdims=True)  # merged boxes
+            if redundant:
+                i = i[iou.sum(1) > 1]  # require redundancy
+
+        output[xi] = torch.from_numpy(x[i]).to(device)
+
+    return output
+
+
+def profile_nms_numpy(n=20, nc=80, na=25200, conf_thres=0.25, iou_thres=0.45):
+    # Benchmark the NumPy NMS engine against torchvision on CPU, parity is tested in tests/test_nms.py. Example usage:
+    #     from utils.general import *; profile_nms_numpy()
+    x = torch.rand(1, na, nc + 5)  # random predictions (xywh, obj, cls)
+    x[..., :2] *= 640  # xy
+    x[..., 2:4] *= 160  # wh
+    x[..., 4] **= 4  # sparse objectness
+    print(f"\n{'mode':>12s}{'torchvision (ms)':>18s}{'numpy (ms)':>14s}{'speedup':>10s}{'identical':>12s}")
+    for mode, kwargs in ('best', {}), ('multi-label', {'multi_label': True}), ('agnostic', {'agnostic': True}):
+        dt, y = [], []
+        for backend in 'torchvision', 'numpy':
+            t = time.time()
+            for _ in range(n):
+                out = non_max_suppression(x, conf_thres, iou_thres, backend=backend, **kwargs)
+            dt.append((time.time() - t) * 1000 / n)
+            y.append(out)
+        identical = all(torch.equal(a, b) for a, b in zip(*y))
+        print(f'{mode:>12s}{dt[0]:18.4g}{dt[1]:14.4g}{dt[0] / dt[1]:10.3g}{str(identical):>12s}')
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
@@ -797,6 +1069,29 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     return output
 
 
+def profile_nms(batch_sizes=(1, 2, 4, 8, 16, 32, 64), n=10, nc=80, na=25200, conf_thres=0.001, iou_thres=0.65,
+                device=None):
+    # Benchmark non_max_suppression() per-image loop against the batched single-call mode. Example usage:
+    #     from utils.general import *; profile_nms(device=torch.device('cuda:0'))
+    device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    print(f"\n{'batch':>8s}{'loop (ms)':>14s}{'batched (ms)':>14s}{'speedup':>10s}{'identical':>12s}")
+    for bs in batch_sizes:
+        x = torch.rand(bs, na, nc + 5, device=device)  # random predictions (xywh, obj, cls)
+        x[..., :2] *= 640  # xy
+        x[..., 2:4] *= 160  # wh
+        x[..., 4] **= 4  # sparse objectness
+        dt, y = [], []
+        for batched in False, True:
+            non_max_suppression(x, conf_thres, iou_thres, multi_label=True, batched=batched)  # warmup
+            t = time_synchronized()
+            for _ in range(n):
+                out = non_max_suppression(x, conf_thres, iou_thres, multi_label=True, batched=batched)
+            dt.append((time_synchronized() - t) * 1000 / n)
+            y.append(out)
+        identical = all(torch.equal(a, b) for a, b in zip(*y))
+        print(f'{bs:8}{dt[0]:14.4g}{dt[1]:14.4g}{dt[0] / dt[1]:10.3g}{str(identical):>12s}')
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -890,3 +1185,68 @@ def increment_path(path, exist_ok=True, sep=''):
         i = [int(m.groups()[0]) for m in matches if m]  # indices
         n = max(i) + 1 if i else 2  # increment number
         return f"{path}{sep}{n}"  # update path
+
+
+class ResultWriter:
+    # Writes detect.py results (label files, images, video frames) from background threads fed by bounded queues
+    # Labels and images use `workers` threads, video frames a single thread so frames stay in order
+    def __init__(self, workers=2, maxsize=32):
+        self.files = queue.Queue(maxsize)  # label and image jobs
+        self.frames = queue.Queue(maxsize)  # video frame jobs
+        self.vid_path, self.vid_writer = None, None
+        self.threads = [Thread(target=self.run, args=(self.files,), daemon=True) for _ in range(workers)]
+        self.threads.append(Thread(target=self.run, args=(self.frames,), daemon=True))
+        for t in self.threads:
+            t.start()
+        self.closed = False
+        atexit.register(self.close)  # flush on exit, also when inference raises
+
+    def run(self, q):
+        # Worker loop, a None job stops it
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            try:
+                job[0](*job[1:])
+            except Exception as e:
+                print(f'WARNING: failed to write results: {e}')
+
+    def labels(self, path, lines):
+        # Queue all label lines of one image, written with a single buffered write
+        self.files.put((self.write_labels, path, lines))
+
+    def image(self, path, im):
+        # Queue an annotated image, encoded and saved off the inference thread
+        self.files.put((cv2.imwrite, path, im))
+
+    def frame(self, path, im, fps, w, h):
+        # Queue an annotated video frame, a new path starts a new video file
+        self.frames.put((self.write_frame, path, im, fps, w, h))
+
+    @staticmethod
+    def write_labels(path, lines):
+        with open(path, 'a') as f:
+            f.write(''.join(f'{x}\n' for x in lines))
+
+    def write_frame(self, path, im, fps, w, h):
+        if self.vid_path != path:  # new video
+            self.vid_path = path
+            if isinstance(self.vid_writer, cv2.VideoWriter):
+                self.vid_writer.release()  # release previous video writer
+            self.vid_writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        self.vid_writer.write(im)
+
+    def close(self):
+        # Write everything still queued, then stop the threads and release the video writer
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)  # the writer can be freed, i.e. when detect() runs repeatedly in one process
+        for t in self.threads[:-1]:
+            self.files.put(None)
+        self.frames.put(None)
+        for t in self.threads:
+            t.join()
+        if isinstance(self.vid_writer, cv2.VideoWriter):
+            self.vid_writer.release()
@@ -6,7 +6,6 @@ import subprocess
 import time
 from pathlib import Path
 
-import requests
 import torch
 
 
@@ -21,6 +20,8 @@ def attempt_download(file, repo='WongKinYiu/yolov7'):
     file = Path(str(file).strip().replace("'", '').lower())
 
     if not file.exists():
+        import requests  # imported here, weights are normally already on disk
+
         try:
             response = requests.get(f'https://api.github.com/repos/{repo}/releases/latest').json()  # github api
             assets = [x['name'] for x in response['assets']]  # release assets
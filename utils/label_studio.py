@@ -0,0 +1,71 @@
+# Label Studio API utils
+
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def api_session(token, retries=3, workers=8):
+    # Keep-alive session with a connection pool sized to the number of workers. Failed requests are retried with
+    # exponential backoff (0.5s, 1s, 2s, ...), for the idempotent methods only (urllib3 default, POST excluded):
+    # an import that failed after the server accepted it would create the same tasks again
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Authorization': 'Token ' + token})
+    return session
+
+
+def project_images(session, api_url, project_id, page_size=1000):
+    # Returns the set of data.image urls of the tasks already in the project, reading the task list page by page
+    # until an empty page or a 404 past the last page (the server may cap page_size, a short page is not the end)
+    images, page = set(), 1
+    while True:
+        response = session.get(f'{api_url}/projects/{project_id}/tasks/', params={'page': page, 'page_size': page_size},
+                               timeout=60)
+        if response.status_code == 404 and page > 1:  # past the last page
+            break
+        response.raise_for_status()
+        tasks = response.json()
+        if isinstance(tasks, dict):  # paginated response
+            tasks = tasks.get('tasks', tasks.get('results', []))
+        if not tasks:
+            break
+        images.update(task.get('data', {}).get('image') for task in tasks)
+        page += 1
+    return images
+
+
+def import_tasks(session, api_url, project_id, tasks, retries=3, backoff=0.5):
+    # Imports tasks (payloads with a unique data.image url) to a project. A failed import is resubmitted with
+    # exponential backoff, but only for the tasks whose image the project does not list yet.
+    # Returns (indices of the tasks now in the project, None or the last error message)
+    remaining, error = list(range(len(tasks))), None
+    for i in range(retries + 1):
+        if i:
+            time.sleep(backoff * 2 ** (i - 1))
+            try:
+                present = project_images(session, api_url, project_id)
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+                continue  # never resubmit without knowing what the server already has
+            remaining = [j for j in remaining if tasks[j]['data']['image'] not in present]
+            if not remaining:
+                return list(range(len(tasks))), None
+
+        try:
+            response = session.post(f'{api_url}/projects/{project_id}/import', json=[tasks[j] for j in remaining],
+                                    timeout=300)
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+            continue
+        if response.status_code == 201:
+            return list(range(len(tasks))), None
+        error = response.text
+        if response.status_code < 500 and response.status_code != 429:  # rejected, resubmitting will not help
+            break
+    return sorted(set(range(len(tasks))) - set(remaining)), error
@@ -513,7 +513,7 @@ class ComputeLoss:
 
         for i in range(self.nl):
             anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+            gain[2:6] = torch.tensor(p[i].shape, device=targets.device)[[3, 2, 3, 2]]  # xyxy gain
 
             # Match targets to anchors
             t = targets * gain
@@ -553,6 +553,138 @@ class ComputeLoss:
         return tcls, tbox, indices, anch
 
 
+class BatchedOTA:
+    # Batched SimOTA target assignment for ComputeLossOTA, ComputeLossBinOTA and ComputeLossAuxOTA
+    # Builds padded (batch, max_gt, max_candidates) cost tensors and matches the whole batch in one pass,
+    # numerically equivalent to the per-image / per-gt loops in build_targets() (tests/test_ota.py). Duplicate candidates
+    # of one grid cell have equal costs, either copy may be matched as topk() does not order ties
+    def __init__(self, nc, stride, topk=10):
+        self.nc = nc  # number of classes
+        self.stride = stride  # detection layer strides
+        self.topk = topk  # number of top IoUs summed for dynamic k
+        self.buffers = {}  # scratch storage reused across steps, grown on demand
+
+    def scratch(self, name, shape, dtype, device, fill=0):
+        # Return a filled view of a reusable buffer, reallocating only to grow or to change dtype/device
+        n = 1
+        for x in shape:
+            n *= x
+        buf = self.buffers.get(name)
+        if buf is None or buf.numel() < n or buf.dtype != dtype or buf.device != device:
+            buf = self.buffers[name] = torch.empty(n, dtype=dtype, device=device)
+        return buf[:n].view(shape).fill_(fill)
+
+    @torch.no_grad()
+    def __call__(self, p, targets, imgs, indices, anch, decode):
+        # p: layer predictions, targets(image,class,x,y,w,h), indices/anch: find_x_positive() candidates
+        # decode(fg_pred, grid, anch, stride) -> candidate boxes xyxy (n,4), obj logits (n,1), cls logits (n,nc)
+        device = p[0].device  # every buffer lives on the predictions' device
+        targets = targets.to(device)
+        nl, bs, nt = len(p), p[0].shape[0], targets.shape[0]
+
+        # Candidates of all layers
+        cb, ca, cgj, cgi, canch, clayer, pxyxys, p_obj, p_cls = [], [], [], [], [], [], [], [], []
+        for i, pi in enumerate(p):
+            b, a, gj, gi = indices[i]
+            fg_pred = pi[b, a, gj, gi]
+            pxyxy, obj, cls = decode(fg_pred, torch.stack([gi, gj], dim=1), anch[i], self.stride[i])
+            cb.append(b)
+            ca.append(a)
+            cgj.append(gj)
+            cgi.append(gi)
+            canch.append(anch[i])
+            clayer.append(torch.full_like(b, i))
+            pxyxys.append(pxyxy.float())
+            p_obj.append(obj)
+            p_cls.append(cls)
+        cb, clayer = torch.cat(cb, 0), torch.cat(clayer, 0)
+        n = cb.shape[0]  # number of candidates
+        if n == 0 or nt == 0:
+            empty = torch.zeros(0, dtype=torch.int64, device=device)
+            return [empty] * nl, [empty] * nl, [empty] * nl, [empty] * nl, [empty] * nl, [empty] * nl
+
+        # Sort candidates image-major, keeping layer then candidate order within each image (as the loop does)
+        order = torch.argsort(cb * n + torch.arange(n, device=device))
+        cb, clayer = cb[order], clayer[order]
+        ca, cgj, cgi = torch.cat(ca, 0)[order], torch.cat(cgj, 0)[order], torch.cat(cgi, 0)[order]
+        canch, pxyxys = torch.cat(canch, 0)[order], torch.cat(pxyxys, 0)[order]
+        p_obj, p_cls = torch.cat(p_obj, 0)[order], torch.cat(p_cls, 0)[order]
+
+        # Per-image positions of candidates and targets
+        tb = targets[:, 0].long()
+        torder = torch.argsort(tb * nt + torch.arange(nt, device=device))  # stable image-major target order
+        tb_sorted = tb[torder]
+        tcount, ccount = torch.bincount(tb, minlength=bs), torch.bincount(cb, minlength=bs)
+        tpos = torch.arange(nt, device=device) - (tcount.cumsum(0) - tcount)[tb_sorted]
+        cpos = torch.arange(n, device=device) - (ccount.cumsum(0) - ccount)[cb]
+        G, M = torch.stack((tcount.max(), ccount.max())).tolist()  # max targets, max candidates per image
+
+        # Padded targets (bs, G)
+        gt_valid = self.scratch('gt_valid', (bs, G), torch.bool, device)
+        gt_valid[tb_sorted, tpos] = True
+        gt_index = self.scratch('gt_index', (bs, G), torch.int64, device)
+        gt_index[tb_sorted, tpos] = torder
+        gt_cls = self.scratch('gt_cls', (bs, G), torch.int64, device)
+        gt_cls[tb_sorted, tpos] = targets[torder, 1].long()
+        txyxy = self.scratch('txyxy', (bs, G, 4), torch.float32, device)
+        txyxy[tb_sorted, tpos] = xywh2xyxy(targets[torder, 2:6] * imgs.shape[2])
+
+        # Padded candidates (bs, M)
+        cand_valid = self.scratch('cand_valid', (bs, M), torch.bool, device)
+        cand_valid[cb, cpos] = True
+        pxyxy = self.scratch('pxyxy', (bs, M, 4), torch.float32, device)
+        pxyxy[cb, cpos] = pxyxys
+        y = (p_cls.float().sigmoid() * p_obj.sigmoid()).sqrt()
+        logits = torch.log(y / (1 - y))
+        cls_logits = self.scratch('cls_logits', (bs, M, self.nc), torch.float32, device)
+        cls_logits[cb, cpos] = logits
+        neg_loss = self.scratch('neg_loss', (bs, M), torch.float32, device)  # BCE against an all-zero target, summed over classes
+        neg_loss[cb, cpos] = (logits.clamp(min=0) + torch.log1p(torch.exp(-logits.abs()))).sum(1)
+        valid = gt_valid[:, :, None] & cand_valid[:, None, :]  # (bs, G, M)
+
+        # IoU cost
+        inter = (torch.min(txyxy[:, :, None, 2:], pxyxy[:, None, :, 2:]) -
+                 torch.max(txyxy[:, :, None, :2], pxyxy[:, None, :, :2])).clamp(0).prod(3)
+        area1 = (txyxy[..., 2] - txyxy[..., 0]) * (txyxy[..., 3] - txyxy[..., 1])
+        area2 = (pxyxy[..., 2] - pxyxy[..., 0]) * (pxyxy[..., 3] - pxyxy[..., 1])
+        pair_wise_iou = (inter / (area1[:, :, None] + area2[:, None, :] - inter)).masked_fill_(~valid, 0.)
+        pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+        top_k, _ = torch.topk(pair_wise_iou, min(self.topk, M), dim=2)
+        dynamic_ks = torch.clamp(top_k.sum(2).int(), min=1)
+
+        # Class cost: BCE(logits, one_hot(cls)).sum(-1) == sum(BCE(logits, 0)) - logits[cls]
+        pair_wise_cls_loss = neg_loss[:, None, :] - cls_logits.transpose(1, 2).gather(1, gt_cls[:, :, None].expand(bs, G, M))
+
+        cost = (pair_wise_cls_loss + 3.0 * pair_wise_iou_loss).masked_fill_(~valid, float('inf'))
+
+        # Dynamic k matching, every gt row at once
+        k = min(self.topk, M)  # dynamic_ks <= topk
+        _, pos_idx = torch.topk(cost, k, dim=2, largest=False)
+        pos_mask = (torch.arange(k, device=device) < dynamic_ks[:, :, None]) & valid.gather(2, pos_idx)
+        matching_matrix = self.scratch('matching', (bs, G, M), cost.dtype, device).scatter_(2, pos_idx, pos_mask.to(cost.dtype))
+
+        # Candidates matched to several gts keep only the lowest-cost gt
+        multiple = matching_matrix.sum(1) > 1  # (bs, M)
+        cost_argmin = cost.argmin(1)
+        matching_matrix.masked_fill_(multiple[:, None, :], 0.)
+        matching_matrix.scatter_add_(1, cost_argmin[:, None, :], multiple[:, None, :].float())
+        fg_mask_inboxes = (matching_matrix.sum(1) > 0.0)[cb, cpos]  # back to sorted candidate order
+        matched_gt_inds = gt_index[cb, matching_matrix.argmax(1)[cb, cpos]]
+
+        matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs = [], [], [], [], [], []
+        for i in range(nl):
+            j = fg_mask_inboxes & (clayer == i)
+            matching_bs.append(cb[j])
+            matching_as.append(ca[j])
+            matching_gjs.append(cgj[j])
+            matching_gis.append(cgi[j])
+            matching_targets.append(targets[matched_gt_inds[j]])
+            matching_anchs.append(canch[j])
+
+        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
+
+
 class ComputeLossOTA:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -578,6 +710,7 @@ class ComputeLossOTA:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'stride':
             setattr(self, k, getattr(det, k))
+        self.assigner = BatchedOTA(self.nc, self.stride, topk=10) if h.get('batched_ota', 0) else None
 
     def __call__(self, p, targets, imgs):  # predictions, targets, model   
         device = targets.device
@@ -642,6 +775,8 @@ class ComputeLossOTA:
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
+        if self.assigner is not None:  # batched SimOTA
+            return self.assigner(p, targets, imgs, indices, anch, self.decode_candidates)
 
         matching_bs = [[] for pp in p]
         matching_as = [[] for pp in p]
@@ -682,7 +817,7 @@ class ComputeLossOTA:
                 all_gj.append(gj)
                 all_gi.append(gi)
                 all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
+                from_which_layer.append(torch.full_like(b, i))
                 
                 fg_pred = pi[b, a, gj, gi]                
                 p_obj.append(fg_pred[:, 4:5])
@@ -783,15 +918,21 @@ class ComputeLossOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs           
 
+    def decode_candidates(self, fg_pred, grid, anch, stride):
+        # Candidate predictions to image-space xyxy boxes, obj and cls logits (same decode as build_targets)
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * stride
+        pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * stride
+        return xywh2xyxy(torch.cat([pxy, pwh], dim=-1)), fg_pred[:, 4:5], fg_pred[:, 5:]
+
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
@@ -808,7 +949,7 @@ class ComputeLossOTA:
 
         for i in range(self.nl):
             anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+            gain[2:6] = torch.tensor(p[i].shape, device=targets.device)[[3, 2, 3, 2]]  # xyxy gain
 
             # Match targets to anchors
             t = targets * gain
@@ -877,6 +1018,7 @@ class ComputeLossBinOTA:
         wh_bin_sigmoid = SigmoidBin(bin_count=self.bin_count, min=0.0, max=4.0, use_loss_regression=False).to(device)
         #angle_bin_sigmoid = SigmoidBin(bin_count=31, min=-1.1, max=1.1, use_loss_regression=False).to(device)
         self.wh_bin_sigmoid = wh_bin_sigmoid
+        self.assigner = BatchedOTA(self.nc, self.stride, topk=10) if h.get('batched_ota', 0) else None
 
     def __call__(self, p, targets, imgs):  # predictions, targets, model   
         device = targets.device
@@ -965,6 +1107,8 @@ class ComputeLossBinOTA:
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
+        if self.assigner is not None:  # batched SimOTA
+            return self.assigner(p, targets, imgs, indices, anch, self.decode_candidates)
 
         matching_bs = [[] for pp in p]
         matching_as = [[] for pp in p]
@@ -1007,7 +1151,7 @@ class ComputeLossBinOTA:
                 all_gj.append(gj)
                 all_gi.append(gi)
                 all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
+                from_which_layer.append(torch.full_like(b, i))
                 
                 fg_pred = pi[b, a, gj, gi]                
                 p_obj.append(fg_pred[:, obj_idx:(obj_idx+1)])
@@ -1110,15 +1254,24 @@ class ComputeLossBinOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs       
 
+    def decode_candidates(self, fg_pred, grid, anch, stride):
+        # Candidate predictions to image-space xyxy boxes, obj and cls logits (same decode as build_targets)
+        obj_idx = self.wh_bin_sigmoid.get_length()*2 + 2
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * stride
+        pw = self.wh_bin_sigmoid.forward(fg_pred[..., 2:(3+self.bin_count)].sigmoid()) * anch[:, 0] * stride
+        ph = self.wh_bin_sigmoid.forward(fg_pred[..., (3+self.bin_count):obj_idx].sigmoid()) * anch[:, 1] * stride
+        pxywh = torch.cat([pxy, pw.unsqueeze(1), ph.unsqueeze(1)], dim=-1)
+        return xywh2xyxy(pxywh), fg_pred[:, obj_idx:(obj_idx+1)], fg_pred[:, (obj_idx+1):]
+
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
@@ -1135,7 +1288,7 @@ class ComputeLossBinOTA:
 
         for i in range(self.nl):
             anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+            gain[2:6] = torch.tensor(p[i].shape, device=targets.device)[[3, 2, 3, 2]]  # xyxy gain
 
             # Match targets to anchors
             t = targets * gain
@@ -1198,6 +1351,7 @@ class ComputeLossAuxOTA:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'stride':
             setattr(self, k, getattr(det, k))
+        self.assigner = BatchedOTA(self.nc, self.stride, topk=20) if h.get('batched_ota', 0) else None
 
     def __call__(self, p, targets, imgs):  # predictions, targets, model   
         device = targets.device
@@ -1287,6 +1441,8 @@ class ComputeLossAuxOTA:
     def build_targets(self, p, targets, imgs):
         
         indices, anch = self.find_3_positive(p, targets)
+        if self.assigner is not None:  # batched SimOTA
+            return self.assigner(p, targets, imgs, indices, anch, self.decode_candidates)
 
         matching_bs = [[] for pp in p]
         matching_as = [[] for pp in p]
@@ -1327,7 +1483,7 @@ class ComputeLossAuxOTA:
                 all_gj.append(gj)
                 all_gi.append(gi)
                 all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
+                from_which_layer.append(torch.full_like(b, i))
                 
                 fg_pred = pi[b, a, gj, gi]                
                 p_obj.append(fg_pred[:, 4:5])
@@ -1428,18 +1584,20 @@ class ComputeLossAuxOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
 
     def build_targets2(self, p, targets, imgs):
         
         indices, anch = self.find_5_positive(p, targets)
+        if self.assigner is not None:  # batched SimOTA
+            return self.assigner(p, targets, imgs, indices, anch, self.decode_candidates)
 
         matching_bs = [[] for pp in p]
         matching_as = [[] for pp in p]
@@ -1480,7 +1638,7 @@ class ComputeLossAuxOTA:
                 all_gj.append(gj)
                 all_gi.append(gi)
                 all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
+                from_which_layer.append(torch.full_like(b, i))
                 
                 fg_pred = pi[b, a, gj, gi]                
                 p_obj.append(fg_pred[:, 4:5])
@@ -1581,15 +1739,21 @@ class ComputeLossAuxOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs              
 
+    def decode_candidates(self, fg_pred, grid, anch, stride):
+        # Candidate predictions to image-space xyxy boxes, obj and cls logits (same decode as build_targets)
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * stride
+        pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * stride
+        return xywh2xyxy(torch.cat([pxy, pwh], dim=-1)), fg_pred[:, 4:5], fg_pred[:, 5:]
+
     def find_5_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
@@ -1606,7 +1770,7 @@ class ComputeLossAuxOTA:
 
         for i in range(self.nl):
             anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+            gain[2:6] = torch.tensor(p[i].shape, device=targets.device)[[3, 2, 3, 2]]  # xyxy gain
 
             # Match targets to anchors
             t = targets * gain
@@ -1659,7 +1823,7 @@ class ComputeLossAuxOTA:
 
         for i in range(self.nl):
             anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+            gain[2:6] = torch.tensor(p[i].shape, device=targets.device)[[3, 2, 3, 2]]  # xyxy gain
 
             # Match targets to anchors
             t = targets * gain
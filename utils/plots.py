@@ -7,23 +7,30 @@ import random
 from copy import copy
 from pathlib import Path
 
+from functools import lru_cache
+
 import cv2
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sns
 import torch
 import yaml
 from PIL import Image, ImageDraw, ImageFont
-from scipy.signal import butter, filtfilt
 
 from utils.general import xywh2xyxy, xyxy2xywh
 from utils.metrics import fitness
 
-# Settings
-matplotlib.rc('font', **{'size': 11})
-matplotlib.use('Agg')  # for writing to files only
+# matplotlib.colors.TABLEAU_COLORS, kept here so drawing boxes does not import matplotlib
+TABLEAU_COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+                  '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf')
+
+
+@lru_cache(maxsize=None)
+def pyplot():
+    # Return matplotlib.pyplot, imported and configured on first use so inference does not pay for it at startup
+    import matplotlib
+    matplotlib.rc('font', **{'size': 11})
+    matplotlib.use('Agg')  # for writing to files only
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def color_list():
@@ -31,7 +38,7 @@ def color_list():
     def hex2rgb(h):
         return tuple(int(h[1 + i:1 + i + 2], 16) for i in (0, 2, 4))
 
-    return [hex2rgb(h) for h in matplotlib.colors.TABLEAU_COLORS.values()]  # or BASE_ (8), CSS4_ (148), XKCD_ (949)
+    return [hex2rgb(h) for h in TABLEAU_COLORS]  # or BASE_ (8), CSS4_ (148), XKCD_ (949)
 
 
 def hist2d(x, y, n=100):
@@ -45,6 +52,8 @@ def hist2d(x, y, n=100):
 
 def butter_lowpass_filtfilt(data, cutoff=1500, fs=50000, order=5):
     # https://stackoverflow.com/questions/28536191/how-to-filter-smooth-with-scipy-numpy
+    from scipy.signal import butter, filtfilt
+
     def butter_lowpass(cutoff, fs, order):
         nyq = 0.5 * fs
         normal_cutoff = cutoff / nyq
@@ -85,6 +94,7 @@ def plot_one_box_PIL(box, img, color=None, label=None, line_thickness=None):
 def plot_wh_methods():  # from utils.plots import *; plot_wh_methods()
     # Compares the two methods for width-height anchor multiplication
     # https://github.com/ultralytics/yolov3/issues/168
+    plt = pyplot()
     x = np.arange(-4.0, 4.0, .1)
     ya = np.exp(x)
     yb = torch.sigmoid(torch.from_numpy(x)).numpy() * 2
@@ -192,6 +202,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
 
 def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     # Plot LR simulating training for full epochs
+    plt = pyplot()
     optimizer, scheduler = copy(optimizer), copy(scheduler)  # do not modify originals
     y = []
     for _ in range(epochs):
@@ -209,6 +220,7 @@ def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
 
 def plot_test_txt():  # from utils.plots import *; plot_test()
     # Plot test.txt histograms
+    plt = pyplot()
     x = np.loadtxt('test.txt', dtype=np.float32)
     box = xyxy2xywh(x[:, :4])
     cx, cy = box[:, 0], box[:, 1]
@@ -226,6 +238,7 @@ def plot_test_txt():  # from utils.plots import *; plot_test()
 
 def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
     # Plot targets.txt histograms
+    plt = pyplot()
     x = np.loadtxt('targets.txt', dtype=np.float32).T
     s = ['x targets', 'y targets', 'width targets', 'height targets']
     fig, ax = plt.subplots(2, 2, figsize=(8, 8), tight_layout=True)
@@ -239,6 +252,7 @@ def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
 
 def plot_study_txt(path='', x=None):  # from utils.plots import *; plot_study_txt()
     # Plot study.txt generated by test.py
+    plt = pyplot()
     fig, ax = plt.subplots(2, 4, figsize=(10, 6), tight_layout=True)
     # ax = ax.ravel()
 
@@ -271,6 +285,11 @@ def plot_study_txt(path='', x=None):  # from utils.plots import *; plot_study_tx
 
 def plot_labels(labels, names=(), save_dir=Path(''), loggers=None):
     # plot dataset labels
+    import matplotlib
+    import pandas as pd
+    import seaborn as sns
+
+    plt = pyplot()
     print('Plotting labels... ')
     c, b = labels[:, 0], labels[:, 1:].transpose()  # classes, boxes
     nc = int(c.max() + 1)  # number of classes
@@ -320,6 +339,9 @@ def plot_labels(labels, names=(), save_dir=Path(''), loggers=None):
 
 def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.plots import *; plot_evolution()
     # Plot hyperparameter evolution results in evolve.txt
+    import matplotlib
+
+    plt = pyplot()
     with open(yaml_file) as f:
         hyp = yaml.load(f, Loader=yaml.SafeLoader)
     x = np.loadtxt('evolve.txt', ndmin=2)
@@ -344,6 +366,7 @@ def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.plots impo
 
 def profile_idetection(start=0, stop=0, labels=(), save_dir=''):
     # Plot iDetection '*.txt' per-image logs. from utils.plots import *; profile_idetection()
+    plt = pyplot()
     ax = plt.subplots(2, 4, figsize=(12, 6), tight_layout=True)[1].ravel()
     s = ['Images', 'Free Storage (GB)', 'RAM Usage (GB)', 'Battery', 'dt_raw (ms)', 'dt_smooth (ms)', 'real-world FPS']
     files = list(Path(save_dir).glob('frames*.txt'))
@@ -376,6 +399,7 @@ def profile_idetection(start=0, stop=0, labels=(), save_dir=''):
 
 def plot_results_overlay(start=0, stop=0):  # from utils.plots import *; plot_results_overlay()
     # Plot training 'results*.txt', overlaying train and val losses
+    plt = pyplot()
     s = ['train', 'train', 'train', 'Precision', 'mAP@0.5', 'val', 'val', 'val', 'Recall', 'mAP@0.5:0.95']  # legends
     t = ['Box', 'Objectness', 'Classification', 'P-R', 'mAP-F1']  # titles
     for f in sorted(glob.glob('results*.txt') + glob.glob('../../Downloads/results*.txt')):
@@ -399,6 +423,7 @@ def plot_results_overlay(start=0, stop=0):  # from utils.plots import *; plot_re
 
 def plot_results(start=0, stop=0, bucket='', id=(), labels=(), save_dir=''):
     # Plot training 'results*.txt'. from utils.plots import *; plot_results(save_dir='runs/train/exp')
+    plt = pyplot()
     fig, ax = plt.subplots(2, 5, figsize=(12, 6), tight_layout=True)
     ax = ax.ravel()
     s = ['Box', 'Objectness', 'Classification', 'Precision', 'Recall',
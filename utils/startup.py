@@ -0,0 +1,92 @@
+# Startup-time profiling utils, standard library only so they can be imported before torch
+
+import builtins
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    # Records the wall time of first-time module imports (down to depth levels) and of named startup phases,
+    # i.e. import, load, fuse, trace, warmup. Every method is a no-op until start() is called
+    def __init__(self, depth=1, min_time=0.005):
+        self.enabled, self.depth, self.min_time = False, depth, min_time
+        self.imports, self.phases = [], []  # (level, module, seconds), (phase, seconds)
+        self.level, self.t0, self.builtin_import = 0, time.perf_counter(), builtins.__import__
+
+    def start(self):
+        # Start timing phases and wrap __import__ to time every module not imported yet
+        if self.enabled:
+            return
+        self.enabled, self.t0 = True, time.perf_counter()
+
+        def timed_import(name, *args, **kwargs):
+            if name in sys.modules or self.level > self.depth:
+                return self.builtin_import(name, *args, **kwargs)
+            i, t = len(self.imports), time.perf_counter()
+            self.imports.append(None)  # reserve the slot so imports print in order
+            self.level += 1
+            try:
+                return self.builtin_import(name, *args, **kwargs)
+            finally:
+                self.level -= 1
+                self.imports[i] = (self.level, name, time.perf_counter() - t)
+
+        builtins.__import__ = timed_import
+
+    def stop_imports(self):
+        # Record the import phase (time since start()) and stop timing imports
+        if self.enabled and builtins.__import__ is not self.builtin_import:
+            builtins.__import__ = self.builtin_import
+            self.phases.append(('import', time.perf_counter() - self.t0))
+
+    @contextmanager
+    def phase(self, name):
+        # Time the enclosed block as startup phase name
+        if not self.enabled:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - t))
+
+    def add(self, name, seconds):
+        # Record a phase timed elsewhere
+        if self.enabled:
+            self.phases.append((name, seconds))
+
+    def report(self):
+        # Print import and phase times once, then disable the profiler
+        if not self.enabled:
+            return
+        self.stop_imports()
+        print(f"\n{'startup':>10s}{'seconds':>10s}  module")
+        for level, name, dt in filter(None, self.imports):
+            if dt >= self.min_time:
+                print(f"{'import':>10s}{dt:10.3f}  {'  ' * level}{name}")
+        for name, dt in self.phases:
+            print(f'{name:>10s}{dt:10.3f}')
+        print(f"{'total':>10s}{time.perf_counter() - self.t0:10.3f}\n")
+        self.enabled = False
+
+
+profiler = StartupProfiler()
+if os.getenv('YOLOV7_PROFILE_STARTUP'):  # i.e. for hubconf.py, detect.py uses --profile-startup
+    profiler.start()
+
+
+def benchmark_startup(args='--source inference/images/horses.jpg --device cpu --nosave', n=5, script='detect.py'):
+    # Cold-start benchmark: wall time of n fresh interpreters running script on CPU, from launch to exit. Example:
+    #     python -c "from utils.startup import benchmark_startup; benchmark_startup()"
+    t, out = [], ''
+    for _ in range(n):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, script, *args.split(), '--profile-startup'],
+                             check=True, capture_output=True, text=True).stdout
+        t.append(time.perf_counter() - t0)
+    print(out[out.find('\n   startup'):].rstrip())  # profile of the last run
+    print(f'\n{script} {args}: cold start {min(t):.3f}s best, {sum(t) / n:.3f}s mean of {n} runs')
@@ -1,6 +1,7 @@
 # YOLOR PyTorch utils
 
 import datetime
+import io
 import logging
 import math
 import os
@@ -342,8 +343,15 @@ def revert_sync_batchnorm(module):
 
 class TracedModel(nn.Module):
 
-    def __init__(self, model=None, device=None, img_size=(640,640)): 
+    def __init__(self, model=None, device=None, img_size=(640,640), save_path='traced_model.pt'): 
         super(TracedModel, self).__init__()
+
+        if isinstance(model, (str, Path)):  # load a model written by TracedModel.save()
+            extra = {'detect.pt': ''}
+            self.model = torch.jit.load(str(model), map_location=device, _extra_files=extra)
+            ckpt = torch.load(io.BytesIO(extra['detect.pt']), map_location=device)
+            self.stride, self.names, self.detect_layer = ckpt['stride'], ckpt['names'], ckpt['detect_layer'].to(device)
+            return
         
         print(" Convert model to Traced-model... ") 
         self.stride = model.stride
@@ -361,13 +369,22 @@ class TracedModel(nn.Module):
         
         traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
         #traced_script_module = torch.jit.script(self.model)
-        traced_script_module.save("traced_model.pt")
-        print(" traced_script_module saved! ")
         self.model = traced_script_module
+        if save_path:
+            self.save(save_path)
+            print(" traced_script_module saved! ")
         self.model.to(device)
         self.detect_layer.to(device)
         print(" model is traced! \n") 
 
+    def save(self, f):
+        # Writes the traced module with the detect layer, stride and names attached, replacing f atomically
+        b = io.BytesIO()
+        torch.save({'detect_layer': self.detect_layer, 'stride': self.stride, 'names': self.names}, b)
+        tmp = f'{f}.{os.getpid()}.tmp'
+        torch.jit.save(self.model, tmp, _extra_files={'detect.pt': b.getvalue()})
+        os.replace(tmp, f)
+
     def forward(self, x, augment=False, profile=False):
         out = self.model(x)
         out = self.detect_layer(out)